@@ -0,0 +1,222 @@
+# coding=utf-8
+# End-to-end benchmarks of the client and the command line tool against the local mock server, so they run
+# without network access. Every mode runs in its own process against a mock server hosted by this process, and
+# reports the images per second, the p50/p99 latency of the HTTP requests, the peak RSS and the peak number of
+# open file descriptors of the client process.
+#
+#   python benchmarks/benchmark.py --images 200 --latency 0.01 --processing-delay 0.2
+#   python benchmarks/benchmark.py --modes optimize_dir_parallel --workers 8 --json
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ['optimize', 'optimize_many', 'async', 'optimize_dir', 'optimize_dir_parallel']
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def create_images(directory, count, size):
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, 'image' + str(index) + '.png')
+        with open(path, 'wb') as f:
+            f.write(PNG_SIGNATURE + os.urandom(size - len(PNG_SIGNATURE)))
+        paths.append(path)
+    return paths
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def count_fds():
+    for directory in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(directory):
+            return len(os.listdir(directory))
+    return None
+
+
+class FdSampler(object):
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = count_fds()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            count = count_fds()
+            if count is not None and count > self.peak:
+                self.peak = count
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+def timed_client(api_url, options, latencies):
+    # Records the duration of every request of the client, including its retries.
+    from megaoptim.client.client import Client
+
+    class TimedClient(Client):
+
+        def request(self, kind, method, url, rewind=None, **kwargs):
+            start = time.time()
+            try:
+                return super(TimedClient, self).request(kind, method, url, rewind, **kwargs)
+            finally:
+                latencies.append(time.time() - start)
+
+    return TimedClient('benchmark', pool_maxsize=max(10, options.workers * 3), api_base_url=api_url)
+
+
+def run_optimize(api_url, options, paths, latencies):
+    with timed_client(api_url, options, latencies) as client:
+        for path in paths:
+            response = client.optimize(path, {})
+            for item in response.get('result') or []:
+                client.download(item['url'], path + '.optimized', item['optimized_size'])
+
+
+def run_optimize_many(api_url, options, paths, latencies):
+    with timed_client(api_url, options, latencies) as client:
+        for path, item in client.optimize_many(paths, {}, batch_size=options.batch_size):
+            client.download(item['url'], path + '.optimized', item['optimized_size'])
+
+
+def run_async(api_url, options, paths, latencies):
+    import asyncio
+    from megaoptim.client.async_client import AsyncClient
+
+    async def optimize(client, path):
+        start = time.time()
+        response = await client.optimize(path, {})
+        for item in response.get('result') or []:
+            await client.download(item['url'], path + '.optimized', item['optimized_size'])
+        latencies.append(time.time() - start)
+
+    async def main():
+        async with AsyncClient('benchmark', concurrency=options.workers * 10, api_base_url=api_url) as client:
+            await asyncio.gather(*[optimize(client, path) for path in paths])
+
+    asyncio.run(main())
+
+
+def run_optimize_dir(api_url, options, paths, latencies, workers=1):
+    from megaoptim.cli import cli
+    directory = os.path.dirname(paths[0])
+    argv = sys.argv
+    sys.argv = ['megaoptim', '--api-key', 'benchmark', '--dir', directory, '--api-url', api_url, '-q',
+                '--workers', str(workers), '--batch-size', str(options.batch_size), '--dedup', '0']
+    try:
+        args = cli.create_args()
+    finally:
+        sys.argv = argv
+    with timed_client(api_url, options, latencies) as client:
+        cli.optimize_dir(args, client, directory, None, cli.prepare_api_params(args), False)
+
+
+def run_optimize_dir_parallel(api_url, options, paths, latencies):
+    run_optimize_dir(api_url, options, paths, latencies, options.workers)
+
+
+def run_child(options):
+    directory = tempfile.mkdtemp(prefix='megaoptim-benchmark-')
+    try:
+        paths = create_images(directory, options.images, options.image_size)
+        latencies = []
+        with FdSampler() as sampler:
+            start = time.time()
+            globals()['run_' + options.mode](options.api_url, options, paths, latencies)
+            elapsed = time.time() - start
+        print(json.dumps({
+            'mode': options.mode,
+            'images': options.images,
+            'seconds': elapsed,
+            'images_per_second': options.images / elapsed if elapsed > 0 else 0.0,
+            # In the async mode the latency is the one of a whole image, in the others of a single request.
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'peak_rss': peak_rss(),
+            'peak_fds': sampler.peak,
+        }))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_mode(mode, api_url, options):
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--mode', mode, '--api-url', api_url,
+               '--images', str(options.images), '--image-size', str(options.image_size),
+               '--batch-size', str(options.batch_size), '--workers', str(options.workers)]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def format_report(report):
+    rss = report['peak_rss']
+    return '%-22s %8.1f img/s  p50 %7.1f ms  p99 %7.1f ms  rss %7s MB  fds %4s' % (
+        report['mode'], report['images_per_second'], report['p50'] * 1000, report['p99'] * 1000,
+        '%.1f' % (rss / 1048576.0) if rss is not None else '-', report['peak_fds'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the MegaOptim client against the local mock server')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma separated modes: ' + ', '.join(MODES))
+    parser.add_argument('--images', default=100, type=int, help='Number of images per mode.')
+    parser.add_argument('--image-size', default=20480, type=int, help='Size of every image in bytes.')
+    parser.add_argument('--batch-size', default=5, type=int, help='Images per request in the batching modes.')
+    parser.add_argument('--workers', default=4, type=int, help='Workers of the parallel modes.')
+    parser.add_argument('--latency', default=0.0, type=float, help='Seconds the mock adds to every request.')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Share of the requests the mock fails.')
+    parser.add_argument('--processing-delay', default=0.1, type=float, help='Seconds every mock job takes.')
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON lines.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        return run_child(options)
+
+    from megaoptim.mock.server import MockServer
+    with MockServer(latency=options.latency, error_rate=options.error_rate,
+                    processing_delay=options.processing_delay) as mock:
+        for mode in options.modes.split(','):
+            if mode not in MODES:
+                parser.error('Unknown mode ' + mode)
+            try:
+                report = run_mode(mode, mock.url, options)
+            except subprocess.CalledProcessError:
+                print('%-22s failed' % mode)
+                continue
+            print(json.dumps(report) if options.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
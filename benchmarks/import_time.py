@@ -0,0 +1,80 @@
+# coding=utf-8
+# Measures the startup time of the command line tool. Every sample runs `megaoptim --help` in a new interpreter
+# and is compared with an empty interpreter, so the report shows the time added by the package on top of the
+# Python startup of the machine. The script fails if the median time added is above the target, 50 ms by
+# default, and lists the slowest modules imported by the command line module.
+#
+#   python benchmarks/import_time.py --runs 20 --target 0.05
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HELP = 'import sys; sys.argv = ["megaoptim", "--help"]; from megaoptim.cli.cli import do; do()'
+
+
+def measure(code, runs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    samples = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, '-c', code], stdout=devnull, stderr=devnull, env=env)
+            samples.append(time.time() - start)
+    return sorted(samples)
+
+
+def slowest_imports(module, count):
+    # Uses -X importtime, available since Python 3.7, and returns the (cumulative microseconds, module) of the
+    # slowest modules imported by `module` itself, without the ones loaded by the interpreter startup.
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    _, output = process.communicate()
+    lines = output.decode('utf-8', 'replace').splitlines()
+    imports = []
+    started = False
+    for line in lines:
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        # The package imports start after the site module.
+        if name == 'site':
+            started = True
+            continue
+        if started:
+            imports.append((int(parts[1].strip()), name))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup time of megaoptim --help')
+    parser.add_argument('--runs', default=15, type=int, help='Number of samples.')
+    parser.add_argument('--target', default=0.05, type=float, help='Maximum median seconds added to the startup.')
+    parser.add_argument('--top', default=10, type=int, help='Number of slowest imports to list.')
+    options = parser.parse_args()
+
+    baseline = measure('pass', options.runs)
+    samples = measure(HELP, options.runs)
+    median_baseline = baseline[len(baseline) // 2]
+    median = samples[len(samples) // 2]
+    added = median - median_baseline
+    print('python -c pass      min %6.1f ms  median %6.1f ms' % (baseline[0] * 1000, median_baseline * 1000))
+    print('megaoptim --help    min %6.1f ms  median %6.1f ms' % (samples[0] * 1000, median * 1000))
+    print('added by megaoptim  median %6.1f ms  (target %.1f ms)' % (added * 1000, options.target * 1000))
+    if sys.version_info >= (3, 7):
+        print('')
+        print('slowest imports of megaoptim.cli.cli:')
+        for microseconds, name in slowest_imports('megaoptim.cli.cli', options.top):
+            print('  %8.1f ms  %s' % (microseconds / 1000.0, name))
+    if added > options.target:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
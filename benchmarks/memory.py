@@ -0,0 +1,120 @@
+# coding=utf-8
+# Checks that the memory of the command line tool stays flat on a large tree. A synthetic tree of small unique
+# images is optimized in place against the local mock server, and the RSS of the client process is sampled every
+# 5% of the recorded images. The script fails if the RSS grows by more than --max-growth MB between the first
+# sample and the end of the run. The default tree has a million files, which takes a few GB of inodes and a couple
+# of hours against the mock server; use --files 40000 for a quick check.
+#
+#   python benchmarks/memory.py --files 1000000 --per-directory 1000 --workers 8
+import argparse
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+SAMPLES = 20
+
+
+def current_rss():
+    # The resident set size now, from /proc on Linux, or the peak one elsewhere.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def create_tree(root, count, per_directory):
+    # Every image is unique, so all of them are hashed and sent.
+    for index in range(count):
+        directory = os.path.join(root, 'd%05d' % (index // per_directory))
+        if index % per_directory == 0:
+            os.mkdir(directory)
+        with open(os.path.join(directory, 'image%07d.png' % index), 'wb') as f:
+            f.write(PNG_SIGNATURE + struct.pack('>Q', index))
+
+
+def run_child(options):
+    from megaoptim.cli import cli
+    from megaoptim.client.client import Client
+    from megaoptim.client.instrumentation import Instrumentation
+
+    step = max(1, options.files // SAMPLES)
+    samples = []
+    state = {'records': 0}
+
+    def sample(event):
+        if event['event'] != 'record':
+            return
+        state['records'] += 1
+        if state['records'] % step == 0:
+            samples.append((state['records'], current_rss()))
+
+    argv = sys.argv
+    sys.argv = ['megaoptim', '--api-key', 'benchmark', '--dir', options.root, '--api-url', options.api_url, '-q',
+                '--workers', str(options.workers), '--dedup', options.dedup]
+    try:
+        args = cli.create_args()
+    finally:
+        sys.argv = argv
+    start = time.time()
+    with Client('benchmark', pool_maxsize=max(10, options.workers * 3), api_base_url=options.api_url,
+                instrumentation=Instrumentation(sample)) as client:
+        cli.optimize_dir(args, client, options.root, None, cli.prepare_api_params(args), True)
+    print(json.dumps({'records': state['records'], 'seconds': time.time() - start, 'samples': samples}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the RSS of the command line tool on a large tree')
+    parser.add_argument('--files', default=1000000, type=int, help='Number of images of the synthetic tree.')
+    parser.add_argument('--per-directory', default=1000, type=int, help='Number of images per directory.')
+    parser.add_argument('--workers', default=8, type=int, help='Workers of the command line tool.')
+    parser.add_argument('--dedup', default='1', choices=['1', '0'], help='Passed to the command line tool.')
+    parser.add_argument('--max-growth', default=64.0, type=float, help='Maximum RSS growth in MB.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        return run_child(options)
+
+    from megaoptim.mock.server import MockServer
+    root = tempfile.mkdtemp(prefix='megaoptim-memory-')
+    try:
+        start = time.time()
+        create_tree(root, options.files, options.per_directory)
+        print('created %d images in %.1f s' % (options.files, time.time() - start))
+        with MockServer() as mock:
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--root', root, '--api-url', mock.url,
+                       '--files', str(options.files), '--workers', str(options.workers), '--dedup', options.dedup]
+            output = subprocess.check_output(command)
+        report = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    samples = report['samples']
+    print('optimized %d images in %.1f s' % (report['records'], report['seconds']))
+    print('%10s  %9s' % ('images', 'rss MB'))
+    for records, rss in samples:
+        print('%10d  %9.1f' % (records, rss / 1048576.0))
+    if len(samples) < 2:
+        return
+    growth = (samples[-1][1] - samples[0][1]) / 1048576.0
+    per_thousand = (samples[-1][1] - samples[0][1]) * 1000.0 / max(1, samples[-1][0] - samples[0][0])
+    print('growth %.1f MB (%.0f bytes per 1000 images, limit %.1f MB)' % (growth, per_thousand, options.max_growth))
+    if growth > options.max_growth:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
-import platform
+import io
+import mmap
+import os.path
+import stat
 
 try:
     from cStringIO import OutputType as cStringIO
@@ -11,15 +14,20 @@ except ImportError:
     from urlparse import urlparse
 
 
+# platform and tempfile are imported on first use, since importing the package is on the startup path of the
+# command line tool.
 def is_windows():
+    import platform
     return platform.system() == 'Windows'
 
 
 def is_linux():
+    import platform
     return platform.system() == 'Linux'
 
 
 def is_osx():
+    import platform
     return platform.system() == 'Darwin'
 
 
@@ -37,9 +45,158 @@ def maybe_set_default(key, value, p):
     return p
 
 
-def get_file(resource):
-    if isinstance(resource, cStringIO):
-        _file = resource.getvalue()
+# The paths are bytes on Python 2, so only the other buffer types hold in-memory images there.
+BUFFER_TYPES = (bytearray, memoryview, mmap.mmap, io.BytesIO, cStringIO) + (() if str is bytes else (bytes,))
+
+
+def is_buffer(resource):
+    return isinstance(resource, BUFFER_TYPES)
+
+
+def is_local_file(resource):
+    return is_buffer(resource) or hasattr(resource, 'read') or os.path.isfile(resource)
+
+
+def resource_name(resource):
+    if is_buffer(resource):
+        # A buffer can be given the name of the file it holds, e.g. a resized copy of a local image.
+        name = getattr(resource, 'name', None)
+        return os.path.basename(name) if isinstance(name, str) else None
+    if hasattr(resource, 'read'):
+        resource = getattr(resource, 'name', None)
+        return os.path.basename(resource) if isinstance(resource, str) else None
+    if validate_url(resource):
+        return os.path.basename(urlparse(resource).path)
+    return os.path.basename(resource)
+
+
+RESOURCE_HELP = 'Invalid resouce type. Resource must be valid image. Also it should any of the following: image url, ' \
+                'local image path, tuple of up to 5 image urls or tuple of up to 5 local image paths. '
+
+
+def prepare_params(params):
+    if params is None:
+        raise Exception('Please provide image optimization parameters')
+    if not isinstance(params, dict):
+        raise Exception('The parameter \'params\' must be of typ dict')
+    # Work on a copy so the urlN/fileN keys of one request never leak into the next one.
+    params = dict(params)
+    params = maybe_set_default('compression', 'intelligent', params)
+    params = maybe_set_default('keep_exif', '1', params)
+    params = maybe_set_default('cmyktorgb', '1', params)
+    params = maybe_set_default('max_width', '0', params)
+    params = maybe_set_default('max_height', '0', params)
+    return params
+
+
+def classify_resource(resource):
+    # Returns the request type together with the form fields of the resource. The fields map the
+    # parameter name (url, urlN, file, fileN) to the url, the local path or the in-memory buffer.
+    if resource is None:
+        raise Exception('Please provide a valid file path to the image')
+    fields = dict()
+    if isinstance(resource, tuple):
+        if len(resource) > 5 or len(resource) < 1:
+            raise Exception(RESOURCE_HELP)
+        valid_files = False
+        valid_urls = all(not is_buffer(item) and validate_url(item) for item in resource)
+        if not valid_urls:
+            valid_files = all(is_local_file(item) for item in resource)
+        if valid_urls:
+            _type, prefix = 'urls', 'url'
+        elif valid_files:
+            _type, prefix = 'files', 'file'
+        else:
+            raise Exception(RESOURCE_HELP)
+        for i, item in enumerate(resource):
+            fields[prefix + str(i + 1)] = item
     else:
-        _file = open(resource, 'rb')
-    return _file
+        if not is_buffer(resource) and validate_url(resource):
+            _type = 'url'
+        elif is_local_file(resource):
+            _type = 'file'
+        else:
+            raise Exception(RESOURCE_HELP)
+        fields[_type] = resource
+    return _type, fields
+
+
+def batch_resources(resources, size=5):
+    # Streams the resources into tuples of up to `size` items. Urls and local paths can not be mixed
+    # in one request so a batch is also closed when the kind of the resource changes.
+    if size < 1 or size > 5:
+        raise Exception('The batch size must be between 1 and 5')
+    batch = []
+    batch_is_url = None
+    for resource in resources:
+        is_url = not is_buffer(resource) and bool(validate_url(resource))
+        if batch and (len(batch) >= size or is_url != batch_is_url):
+            yield tuple(batch)
+            batch = []
+        batch.append(resource)
+        batch_is_url = is_url
+    if batch:
+        yield tuple(batch)
+
+
+def map_results(sources, results):
+    # Maps every entry of the `result` array back to its source. The entries are matched by file name and
+    # the ones that can not be matched unambiguously fall back to the position in the request.
+    mapped = [None] * len(sources)
+    names = [resource_name(x) for x in sources]
+    unmatched = []
+    for item in results:
+        name = item.get('file_name')
+        if name is not None and names.count(name) == 1 and mapped[names.index(name)] is None:
+            mapped[names.index(name)] = item
+        else:
+            unmatched.append(item)
+    for i in range(len(mapped)):
+        if mapped[i] is None and unmatched:
+            mapped[i] = unmatched.pop(0)
+    return list(zip(sources, mapped))
+
+
+def requires_upload(_type):
+    return _type == 'file' or _type == 'files'
+
+
+def create_temp_file(save_path):
+    # The temporary file is created next to the target so it can be renamed over it atomically.
+    import tempfile
+    directory, name = os.path.split(save_path)
+    return tempfile.mkstemp(prefix='.' + name + '.', suffix='.part', dir=directory or '.')
+
+
+def read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# os.umask changes the mask of the whole process, so it is read once on import, before the download threads
+# start creating files and directories.
+UMASK = read_umask()
+
+
+def commit_temp_file(temp_path, save_path):
+    # Gives the new file the permissions of the file it replaces, or the default ones, since mkstemp
+    # creates it readable only by the owner.
+    if os.path.exists(save_path):
+        mode = stat.S_IMODE(os.stat(save_path).st_mode)
+    else:
+        mode = 0o666 & ~UMASK
+    os.chmod(temp_path, mode)
+    if hasattr(os, 'replace'):
+        os.replace(temp_path, save_path)
+    else:
+        if is_windows() and os.path.exists(save_path):
+            os.remove(save_path)
+        os.rename(temp_path, save_path)
+
+
+def remove_temp_file(temp_path):
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
@@ -1,31 +1,31 @@
-import logging
 import argparse
 import os
-import csv
 import errno
+import itertools
+import threading
 import time
 import datetime
-import requests
-import traceback
-import imghdr
 
+from megaoptim import batch_resources, commit_temp_file, create_temp_file, remove_temp_file
 from megaoptim._version import __version__
 
-from Pillow import Image
+from megaoptim.cli.pipeline import Pipeline
+from megaoptim.cli.scanner import parse_exclude, scan_images, sniff_image, verify_image
 
-from megaoptim.client.client import Client
+# The modules that load requests, sqlite3, the HTTP server or an image library are imported by the functions that
+# use them, so the command line starts fast and --help or --version do not load them at all.
 
-log = logging.getLogger(__name__)
+# The stages of --workers log from their own threads, the lock keeps their lines whole.
+OUTPUT_LOCK = threading.Lock()
 
 
 def log_output(args, text, level="standard"):
     current_time = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
     if 'quiet' in args and args.quiet == 1:
         return
-    if level == 'verbose':
-        if 'verbose' in args and args.verbose == 1:
-            print(current_time + " - " + text)
-    else:
+    if level == 'verbose' and not ('verbose' in args and args.verbose == 1):
+        return
+    with OUTPUT_LOCK:
         print(current_time + " - " + text)
 
 
@@ -37,11 +37,26 @@ def create_args():
         help='The api key obtained from MegaOptim.com. This is required for the script to run!',
     )
 
+    parser.add_argument(
+        '--api-url',
+        default='https://api.megaoptim.com/v1/',
+        help='Base url of the MegaOptim API. Can point to a compatible server such as the local mock server, e.g. '
+             '"http://127.0.0.1:8000/v1/".',
+    )
+
     parser.add_argument(
         '--dir',
         help='Full or relative path to directory that you want to be optimized.',
     )
 
+    parser.add_argument(
+        '--input',
+        help='Path of a file listing the urls or paths of the images to optimize instead of --dir, one per line or '
+             'as JSON lines with a "url" or "path" key. "-" reads the list from the standard input. Requires '
+             '--outdir, where the images of the urls are saved as host/path. The position in a file is saved, so '
+             'an interrupted run continues where it stopped.',
+    )
+
     parser.add_argument(
         '--outdir',
         help='Full or relative path to directory that you want to use to store the optimized path. Warning: If you don\'t '
@@ -83,11 +98,277 @@ def create_args():
 
     )
 
+    parser.add_argument(
+        '--resize-locally',
+        default='0',
+        help='1 to reduce the images larger than --max-width/--max-height before uploading them, which saves upload '
+             'bandwidth. The EXIF data is kept according to --keep-exif. Requires Pillow.',
+        choices=['1', '0']
+    )
+
     parser.add_argument(
         '--exclude',
         default='0',
-        help='Comma separated full paths of folders. Eg. "/path/to/folder1,/path/to/folder2"',
+        help='Comma separated full paths of folders to skip with their subfolders. Eg. "/path/to/folder1,/path/to/folder2"',
+
+    )
+
+    parser.add_argument(
+        '--verify-images',
+        default='0',
+        help='1 to fully decode every image with Pillow before sending it and skip the broken ones. Requires Pillow, '
+             'by default the images are only detected by their signature.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--prefilter',
+        default='0',
+        help='Checks the headers of every image before sending it. "skip" does not send the images that are unlikely '
+             'to get smaller, "defer" sends them after all the others. The images produced by previous runs are '
+             'skipped in both modes. The decisions are reported in the summary.',
+        choices=['0', 'skip', 'defer']
+    )
+
+    parser.add_argument(
+        '--prefilter-jpeg-quality',
+        default=75,
+        type=int,
+        help='JPEGs saved at this estimated quality or lower are low-yield for --prefilter.',
+    )
+
+    parser.add_argument(
+        '--prefilter-jpeg-bpp',
+        default=0.1,
+        type=float,
+        help='JPEGs with fewer bytes per pixel than this are low-yield for --prefilter.',
+    )
+
+    parser.add_argument(
+        '--prefilter-png-bpp',
+        default=0.3,
+        type=float,
+        help='PNGs with fewer bytes per pixel than this are low-yield for --prefilter, palette PNGs always are.',
+    )
+
+    parser.add_argument(
+        '--prefilter-metadata',
+        default=4096,
+        type=int,
+        help='Images with at least this many bytes of metadata are always sent by --prefilter, unless --keep-exif 1.',
+    )
+
+    parser.add_argument(
+        '--manifest',
+        help='Path to the manifest database that records the optimized images. Defaults to the .megaoptim.db of the '
+             'outermost parent directory that has one, so a subdirectory shares the records of its parents, or of '
+             'the optimized directory. Existing .megaoptim files are imported automatically.',
+    )
+
+    parser.add_argument(
+        '--incremental',
+        default='1',
+        help='1 to optimize again the images that were modified since they were optimized, detected by their size '
+             'and modification time. 0 to skip every image that was optimized before.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--check-inode',
+        default='0',
+        help='1 to also treat an image as modified when its inode changed, e.g. after it was replaced.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--dedup',
+        default='1',
+        help='1 to send only one copy of identical images and reuse its optimized file for the other copies, also '
+             'across runs. 0 to send every image.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--pool-size',
+        default=10,
+        type=int,
+        help='Maximum number of keep-alive connections kept open per host.',
+    )
+
+    parser.add_argument(
+        '--download-chunk-size',
+        default=1048576,
+        type=int,
+        help='Size in bytes of the buffer used to write the downloaded images.',
+    )
+
+    parser.add_argument(
+        '--rate-limit',
+        type=float,
+        help='Maximum number of API requests per second. Unlimited by default.',
+    )
+
+    parser.add_argument(
+        '--retries',
+        default=3,
+        type=int,
+        help='Number of times a failed request is retried. Uploads are retried only if they did not reach the server '
+             'or were refused with 429 or 503, the result polls and the downloads on any error, 429 or 5xx.',
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        default=5,
+        type=int,
+        choices=[1, 2, 3, 4, 5],
+        help='Number of images sent in a single optimization request.',
+    )
+
+    parser.add_argument(
+        '--batch-bytes',
+        default=10485760,
+        type=int,
+        help='Maximum total size in bytes of the images sent in a single optimization request. The images larger '
+             'than half of it are sent alone, interleaved with the batches of smaller images. 0 for no limit.',
+    )
+
+    parser.add_argument(
+        '--priority',
+        default='scan',
+        choices=['scan', 'newest', 'oldest', 'smallest', 'largest'],
+        help='Order in which the images are sent: as they are found, the most or least recently modified first, or '
+             'the smallest or largest first. The images are ordered within the --schedule-window next images.',
+    )
+
+    parser.add_argument(
+        '--schedule-window',
+        default=100,
+        type=int,
+        help='Number of found images the batches are chosen from. A larger window packs and orders the images '
+             'better, 0 orders all the images of the directory before sending any.',
+    )
+
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='Number of parallel uploads, result waits and downloads. With 1 the images are processed sequentially.',
+    )
+
+    parser.add_argument(
+        '--adaptive',
+        default='0',
+        help='1 to adjust the number of parallel uploads and downloads between --min-workers and --workers from '
+             'their latency, the time the results take and the errors: the limits grow while the API keeps up and '
+             'are halved when it slows down or fails. The changes are printed with -v.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--min-workers',
+        default=1,
+        type=int,
+        help='Minimum number of parallel uploads and downloads with --adaptive.',
+    )
+
+    parser.add_argument(
+        '--max-pending',
+        type=int,
+        help='Maximum number of optimization requests waiting for their results in --workers mode. '
+             'Defaults to 10 times the number of workers.',
+    )
+
+    parser.add_argument(
+        '--callback-listen',
+        help='host:port to receive the optimization results on instead of polling for them, e.g. "0.0.0.0:8080". '
+             'The results are still polled if the callback does not arrive within a minute.',
+    )
 
+    parser.add_argument(
+        '--callback-url',
+        help='Public url of the --callback-listen address as reachable by the MegaOptim servers, e.g. '
+             '"https://example.com:8080". Defaults to http://host:port.',
+    )
+
+    parser.add_argument(
+        '--resume-max-age',
+        default=86400,
+        type=int,
+        help='The optimization requests of an interrupted run are recorded in the manifest and their results are '
+             'fetched on the next run instead of sending the images again, if they are not older than this number '
+             'of seconds. 0 to send the images again.',
+    )
+
+    parser.add_argument(
+        '--shard',
+        help='i/N to optimize only the i-th of N parts of the directory, e.g. 0/4 to 3/4 on four hosts sharing it. '
+             'The images are split by a hash of their path relative to --dir, and the results are recorded in the '
+             'same manifest.',
+    )
+
+    parser.add_argument(
+        '--leases',
+        default='0',
+        help='1 to claim every image in the manifest before sending it, so several processes or hosts can optimize '
+             'the same directory without sending an image twice.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--lease-ttl',
+        default=900,
+        type=int,
+        help='Number of seconds after which the images claimed by a process that stopped can be claimed by others.',
+    )
+
+    parser.add_argument(
+        '--watch',
+        default='0',
+        help='1 to keep running after the directory was optimized and optimize the new and modified images as they '
+             'are written to it. Uses inotify on Linux and polls the directory elsewhere. Stop it with Ctrl+C.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--watch-settle',
+        default=2.0,
+        type=float,
+        help='Number of seconds the size and modification time of a new image must stay the same before it is '
+             'optimized in --watch mode, so partially written files are not sent.',
+    )
+
+    parser.add_argument(
+        '--watch-interval',
+        default=5.0,
+        type=float,
+        help='Number of seconds between the scans of the directory when --watch polls it.',
+    )
+
+    parser.add_argument(
+        '--watch-polling',
+        default='0',
+        help='1 to poll the directory in --watch mode even if inotify is available, e.g. on network file systems.',
+        choices=['1', '0']
+    )
+
+    parser.add_argument(
+        '--trace',
+        help='Path of a file to append a JSON line to for every upload, result poll, download, retry and stage of the '
+             'run, with its duration.',
+    )
+
+    parser.add_argument(
+        '--metrics',
+        help='Path of a file to write the duration histograms and the request counters to at the end of the run, '
+             'in the Prometheus text format.',
+    )
+
+    parser.add_argument(
+        '--timings',
+        default='0',
+        help='1 to print the count and the duration percentiles of the uploads, result waits, downloads and the '
+             'other stages at the end of the run.',
+        choices=['1', '0']
     )
 
     group = parser.add_mutually_exclusive_group()
@@ -127,191 +408,763 @@ def prepare_api_params(args):
         params['keep_exif'] = args.keep_exif
     if 'max_width' in args:
         params['max_width'] = args.max_width
-    if 'max_width' in args:
-        params['max_width'] = args.max_width
+    if 'max_height' in args:
+        params['max_height'] = args.max_height
     return params
 
 
-def download_url(url, save_path):
-    if not os.path.isdir(save_path) and os.path.exists(save_path):
-        os.remove(save_path)
-    r = requests.get(url, stream=True)
-    with open(save_path, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-    return os.path.exists(save_path)
+def download_url(client, url, save_path, expected_size=None):
+    return client.download(url, save_path, expected_size)
+
+
+def get_manifest_path(args, directory):
+    from megaoptim.cli.manifest import find_manifest
+    if 'manifest' in args and args.manifest is not None:
+        return os.path.realpath(args.manifest)
+    return find_manifest(directory)
+
+
+def create_skip(args, manifest, root):
+    incremental = getattr(args, 'incremental', '1') == '1'
+    check_inode = getattr(args, 'check_inode', '0') == '1'
+    shard = None
+    if getattr(args, 'shard', None):
+        from megaoptim.cli.coordination import parse_shard, shard_of
+        shard = parse_shard(args.shard)
+
+    def skip(path, stat):
+        # The files of the other shards are skipped before the manifest is checked or the file is opened.
+        if shard is not None and shard_of(path, root, shard[1]) != shard[0]:
+            return True
+        # In incremental mode the files that did not change since they were optimized are skipped by their
+        # size and mtime without being opened, and the modified ones are optimized again.
+        if incremental:
+            return manifest.is_unchanged(path, stat, check_inode)
+        return manifest.contains(path)
+
+    return skip
+
+
+def create_scope(args, root, recursive):
+    # Tells if a file is one the scan of the directory would find. The manifest can be shared with the runs on
+    # the parent directories, the other subdirectories and the other shards, whose jobs are left to them.
+    prefixes = [path + os.sep for path in parse_exclude(getattr(args, 'exclude', None))]
+    shard = None
+    if getattr(args, 'shard', None):
+        from megaoptim.cli.coordination import parse_shard, shard_of
+        shard = parse_shard(args.shard)
+    tree = root.rstrip(os.sep) + os.sep
+
+    def in_scope(path):
+        if not path.startswith(tree) or any(path.startswith(prefix) for prefix in prefixes):
+            return False
+        if not recursive and os.sep in path[len(tree):]:
+            return False
+        return shard is None or shard_of(path, root, shard[1]) == shard[0]
+
+    return in_scope
+
+
+def scan_directory(args, directory, recursive, manifest):
+    verify = getattr(args, 'verify_images', '0') == '1'
+    skip = create_skip(args, manifest, directory)
+
+    def migrate(subDirectory):
+        # Import the legacy .megaoptim file and the manifest of the directory before its files are checked.
+        count = manifest.migrate_directory(subDirectory)
+        if count > 0:
+            log_output(args, "Imported " + str(count) + " records from " + subDirectory, level="verbose")
+
+    # If recursive=true it will go recursively. The files are yielded while the walk continues.
+    exclude = parse_exclude(getattr(args, 'exclude', None))
+    for path, stat in scan_images(directory, recursive, exclude, skip=skip, on_directory=migrate):
+        if verify and not verify_image(path):
+            log_output(args, "Skipping " + path + ". The image is broken.", level="verbose")
+            continue
+        yield path
+
+
+def select_files(args, manifest, directory, paths, outdir):
+    # Applies the checks of scan_directory to the files reported by the watcher. The files written to the
+    # optimized directory and the excluded directories are ignored.
+    verify = getattr(args, 'verify_images', '0') == '1'
+    skip = create_skip(args, manifest, directory)
+    ignored = [path + os.sep for path in parse_exclude(getattr(args, 'exclude', None))]
+    if outdir is not None and outdir != 0:
+        ignored.append(outdir + os.sep)
+    for path in paths:
+        if any(path.startswith(prefix) for prefix in ignored):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if skip(path, stat) or sniff_image(path) is None:
+            continue
+        if verify and not verify_image(path):
+            log_output(args, "Skipping " + path + ". The image is broken.", level="verbose")
+            continue
+        yield path
+
+
+def timed_items(instrumentation, name, items):
+    # Emits the time spent producing every item, e.g. scanning the directories.
+    if instrumentation is None:
+        return items
+
+    def generate():
+        iterator = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            instrumentation.emit(name, start, path=item)
+            yield item
+
+    return generate()
+
+
+def save_result(manifest, result):
+    manifest.save(result)
+
+
+def save_file(args, client, url, save_path, expected_size=None):
+    try:
+        status = download_url(client, url, save_path, expected_size)
+    except Exception as e:
+        log_output(args, "Failed to download " + url + ": " + str(e), level="verbose")
+        return False
+    if status is True:
+        return save_path
+    return status
 
 
-def get_data_dir_path(path):
-    return path + os.sep + '.megaoptim'
+def dump_object(obj):
+  for attr in dir(obj):
+    print("obj.%s = %r" % (attr, getattr(obj, attr)))
 
 
-def get_optimized_paths(args, data_storage_path):
-    optimized = []
-    if not os.path.exists(data_storage_path) or not os.path.isfile(data_storage_path):
-        return optimized
-    with open(data_storage_path, mode='r') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for i in csv_reader:
-            optimized.append(i['old_path'])
-    return optimized
+def get_save_path(item, outdir):
+    if outdir is None or outdir == 0:
+        return item
+    return outdir + os.sep + os.path.basename(item)
 
 
-def find_files_recursively(treeroot):
-    file_iterator = (os.path.join(root, f)
-                for root, _, files in os.walk(treeroot)
-                for f in files)
-    files = (f for f in file_iterator if (is_valid_image(f)))
-    return list(files)
+def prepare_outdir(args, outdir):
+    if outdir is None or outdir == 0:
+        return
+    if not os.path.isdir(outdir):
+        try:
+            os.mkdir(outdir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            pass
+    log_output(args, "Checking if the target path " + outdir + " is writable...", level="verbose")
+    if not os.access(outdir, os.W_OK):
+        raise Exception("The save directory " + outdir + " is not writable :(")
+
+
+def make_directories(directory):
+    # Several download threads can create the same directory at once.
+    try:
+        os.makedirs(directory)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
 
 
-def find_files(treeroot):
-    sep = ''
-    if not treeroot.endswith('/'):
-        sep = os.path.sep
-    return [os.path.join(treeroot, f) for f in os.listdir(treeroot) if (is_valid_image(treeroot + sep + f))]
+def count_files(args, files, totals):
+    for item in files:
+        totals['found_count'] += 1
+        yield item
+    log_output(args, "Found total " + str(totals['found_count']) + " images", level="verbose")
 
 
-def scan_directory(args, directory, recursive):
-    if recursive:
-        found_files = find_files_recursively(directory)
+def announce_files(args, files):
+    for item in files:
+        log_output(args, "Processing file " + os.path.basename(item))
+        yield item
+
+
+def process_result(args, client, item, ritem, outdir, save_path=None):
+    if ritem.get('errors'):
+        log_output(args, "Failed to optimize file " + os.path.basename(item) + ": " + ', '.join(
+            str(error) for error in ritem['errors']))
+        return None
+    # A resized copy may have been uploaded, the savings are counted against the local file.
+    local_size = os.path.getsize(item) if os.path.isfile(item) else None
+    if local_size and ritem.get('optimized_size') is not None and ritem.get('original_size') != local_size:
+        ritem['original_size'] = local_size
+        ritem['saved_bytes'] = local_size - int(ritem['optimized_size'])
+        ritem['saved_percent'] = int(100 * ritem['saved_bytes'] / local_size) if local_size else 0
+    if ritem.get('saved_bytes', 0) <= 0:
+        log_output(args, "Skipping. Already optimized, no need more optimization.")
+        # Recorded as its own optimized file, so the next runs skip it and --prefilter recognizes its copies.
+        # A url is recorded without an optimized file.
+        ritem['old_path'] = item
+        ritem['optimized_path'] = item if local_size is not None else None
+        if local_size is not None:
+            ritem['optimized_size'] = local_size
+        ritem['already_optimized'] = True
+        ritem['date'] = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+        return ritem
+    if ritem.get('url') is None:
+        log_output(args, "Failed to save file " + os.path.basename(item) + ": Missing optimization url.")
+        return None
+    ritem['old_path'] = item
+    if save_path is None:
+        save_path = get_save_path(item, outdir)
     else:
-        found_files = find_files(directory)
-
-    # Create unique directories list and collect all the optimized paths.
-    # If recursive=true it will go recursively.
-    directories = []
-    optimized = []
-    for file in found_files:
-        directories.append(os.path.dirname(file))
-    directories = list(set(directories))
-
-    for subDirectory in directories:
-        _optimized_paths = get_optimized_paths(args, get_data_dir_path(subDirectory))
-        if len(_optimized_paths) > 0:
-            optimized.extend(_optimized_paths)
-
-    if len(optimized) > 0:
-        filtered = [x for x in found_files if x not in optimized]
-        found_files = filtered
-        del filtered
-
-    return found_files
-
-
-def save_result(args, result):
-    original_dir = os.path.dirname(result['old_path'])
-    data_storage_path = get_data_dir_path(original_dir)
-    keys = result.keys()
-    first_time = False
-    if not os.path.exists(data_storage_path):
-        first_time = True
-    with open(data_storage_path, 'a+') as output_file:
-        dict_writer = csv.DictWriter(output_file, keys)
-        # if this is first time creation of the file then append header
-        if first_time:
-            dict_writer.writeheader()
-        dict_writer.writerow(result)
-
-
-def save_file(args, url, save_path):
-    status = download_url(url, save_path)
-    if status is True:
-        return save_path
-    return status
+        make_directories(os.path.dirname(save_path))
+    ritem['optimized_path'] = save_file(args, client, url=ritem['url'], save_path=save_path,
+                                        expected_size=ritem.get('optimized_size'))
+    if not ritem['optimized_path']:
+        log_output(args, "Failed to optimize file " + os.path.basename(item))
+        return None
+    log_output(args, "File " + os.path.basename(item) + " successfully optimized.")
+    ritem['date'] = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+    return ritem
+
+
+def record_result(args, manifest, ritem, totals):
+    if ritem.get('already_optimized'):
+        totals['already_optimized'] += 1
+    else:
+        totals['optimized_count'] += 1
+        totals['total_saved'] += (ritem['saved_bytes'] / 1024) / 1024
+        totals['total_size'] += ritem['original_size']
+    save_result(manifest, ritem)
 
 
-def dump_object(obj):
-  for attr in dir(obj):
-    print("obj.%s = %r" % (attr, getattr(obj, attr)))
+def copy_file(source_path, save_path):
+    # Like the downloads, the copy is written to a temporary file that replaces the target once complete, so a
+    # failed copy never leaves a truncated image behind.
+    import shutil
+    fd, temp_path = create_temp_file(save_path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, f)
+        commit_temp_file(temp_path, save_path)
+    except Exception:
+        remove_temp_file(temp_path)
+        raise
+
+
+def record_duplicates(args, manifest, duplicates, outdir, totals):
+    for item, digest, source in duplicates:
+        save_path = get_save_path(item, outdir)
+        if source['optimized_path'] != save_path:
+            # A copy that fails is skipped, it is optimized by the next run.
+            try:
+                copy_file(source['optimized_path'], save_path)
+            except (IOError, OSError) as e:
+                log_output(args, "Failed to copy the optimized identical image " + source['optimized_path'] +
+                           " to " + save_path + ": " + str(e))
+                continue
+        ritem = dict(source)
+        ritem['old_path'] = item
+        ritem['optimized_path'] = save_path
+        ritem['source_hash'] = digest
+        ritem['date'] = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+        log_output(args, "File " + os.path.basename(item) + " successfully optimized. Copied the optimized identical "
+                                                           "image " + source['optimized_path'] + ".")
+        record_result(args, manifest, ritem, totals)
+
+
+def resume_jobs(args, client, manifest, journal, outdir, totals, leases=None, in_scope=None):
+    # Fetches the results of the jobs that an interrupted run had sent but not finished. The images that were
+    # modified or recorded since are left alone, the ones whose result is gone are sent again by the scan. Only
+    # the jobs whose images are all in_scope(path) are taken over, and only from the processes known to have
+    # stopped. The processes of the other hosts can not be checked, so their jobs are taken over only with
+    # leases, if their images are not claimed by the process any longer.
+    from megaoptim.cli.journal import is_stopped
+    from megaoptim.cli.manifest import file_hash
+    from megaoptim.client.poller import ResultPoller
+    max_age = getattr(args, 'resume_max_age', 86400)
+    if not max_age:
+        return
+    jobs = []
+    for process_id, sources, owner in journal.unfinished(max_age):
+        if in_scope is not None and not all(in_scope(source[0]) for source in sources):
+            continue
+        stopped = is_stopped(owner)
+        if stopped or (stopped is None and leases is not None):
+            jobs.append((process_id, sources))
+    if leases is not None:
+        jobs = [(process_id, sources) for process_id, sources in jobs
+                if leases.claim_all([source[0] for source in sources])]
+    if not jobs:
+        return
+    log_output(args, "Resuming " + str(len(jobs)) + " unfinished optimization requests of the previous run",
+               level="verbose")
+    with ResultPoller(client, timeout=300) as poller:
+        for process_id, sources in jobs:
+            poller.add(process_id, (process_id, sources))
+        for (process_id, sources), response in poller.as_completed():
+            if response.get('status') != 'ok':
+                log_output(args, "Could not resume the optimization request " + process_id + ", its images will be "
+                                                                                            "sent again.",
+                           level="verbose")
+                journal.remove(process_id)
+                continue
+            pending = {}
+            for path, size, mtime in sources:
+                if not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                if stat.st_size != size or stat.st_mtime != mtime or manifest.is_unchanged(path, stat):
+                    continue
+                pending[path] = file_hash(path)
+            paths = tuple(source[0] for source in sources)
+            for item, ritem in client.batch_results(paths, response):
+                if item not in pending:
+                    continue
+                totals['found_count'] += 1
+                log_output(args, "Processing file " + os.path.basename(item))
+                ritem = process_result(args, client, item, ritem, outdir)
+                if ritem is not None:
+                    ritem['source_hash'] = pending[item]
+                    yield ritem
+            journal.remove(process_id)
+
+
+def optimize_sequential(args, client, files, outdir, params, batch_size, receiver=None, journal=None, prepare=None,
+                        batcher=None, locate=None, on_failed=None):
+    # locate(item) can return the save path of every image instead of the one in outdir, on_failed(item) is
+    # called for the images that could not be optimized.
+    for item, ritem in client.optimize_many(files, params, batch_size=batch_size, receiver=receiver,
+                                            journal=journal, prepare=prepare, batcher=batcher):
+        ritem = process_result(args, client, item, ritem, outdir, locate(item) if locate is not None else None)
+        if ritem is not None:
+            yield ritem
+        elif on_failed is not None:
+            on_failed(item)
+
+
+def optimize_parallel(args, client, files, outdir, params, batch_size, workers, receiver=None, journal=None,
+                      prepare=None, batcher=None, locate=None, on_failed=None):
+    # Upload, result waiting and download run as separate stages of `workers` threads each. The stages are
+    # connected by bounded queues so the number of uploads, pending jobs and downloads in flight is bounded.
+    # The pending jobs are polled together by the result poller, so they do not hold a connection each.
+    from megaoptim.client.poller import ResultPoller
+    poller = ResultPoller(client, timeout=300, receiver=receiver)
+    if receiver is not None:
+        params = dict(params)
+        params['callback_url'] = receiver.url
+
+    def upload(batch):
+        try:
+            resources = prepare(batch) if prepare is not None else batch
+            response = client.send(resources if len(resources) > 1 else resources[0], params)
+        except Exception as e:
+            response = {'status': 'error', 'errors': [str(e)]}
+        if journal is not None and response.get('status') == 'processing':
+            journal.record(response.get('process_id'), batch, params)
+        yield batch, response
+
+    def wait(submitted):
+        batch, response = submitted
+        try:
+            if response.get('status') == 'processing':
+                response = poller.submit(response.get('process_id')).result()
+        except Exception as e:
+            response = {'status': 'error', 'errors': [str(e)]}
+        for pair in client.batch_results(batch, response):
+            yield pair
+
+    def download(pair):
+        save_path = locate(pair[0]) if locate is not None else None
+        ritem = process_result(args, client, pair[0], pair[1], outdir, save_path)
+        if ritem is not None:
+            yield ritem
+        elif on_failed is not None:
+            on_failed(pair[0])
+
+    max_pending = getattr(args, 'max_pending', None) or workers * 10
+    pipeline = Pipeline(queue_size=workers * 2)
+    pipeline.add_stage(upload, workers).add_stage(wait, max_pending).add_stage(download, workers)
+    try:
+        batches = batcher(files) if batcher is not None else batch_resources(files, batch_size)
+        for ritem in pipeline.run(batches):
+            yield ritem
+    finally:
+        poller.close()
+
+
+def create_prefilter(args, manifest):
+    mode = getattr(args, 'prefilter', '0')
+    if mode == '0':
+        return None
+    from megaoptim.cli.prefilter import Prefilter
+    return Prefilter(manifest, getattr(args, 'keep_exif', '0'), jpeg_quality=args.prefilter_jpeg_quality,
+                     jpeg_bpp=args.prefilter_jpeg_bpp, png_bpp=args.prefilter_png_bpp,
+                     metadata_bytes=args.prefilter_metadata, defer=mode == 'defer')
+
+
+def create_resizer(args, params):
+    if getattr(args, 'resize_locally', '0') != '1':
+        return None
+    if int(params.get('max_width') or 0) <= 0 and int(params.get('max_height') or 0) <= 0:
+        return None
+    from megaoptim.cli.resize import Resizer
+    return Resizer(params.get('max_width'), params.get('max_height'), params.get('keep_exif', '0'))
+
+
+def create_scheduler(args, batch_size):
+    from megaoptim.cli.scheduler import Scheduler
+
+    def log_batch(batch, size):
+        if len(batch) == 1:
+            text = "Scheduled " + os.path.basename(batch[0]) + " alone"
+        else:
+            text = "Scheduled a batch of " + str(len(batch)) + " images: " + ", ".join(
+                os.path.basename(path) for path in batch)
+        log_output(args, text + " (" + str(round(size / 1024.0 / 1024.0, 2)) + " MB)", level="verbose")
 
+    return Scheduler(batch_size, getattr(args, 'batch_bytes', 0), getattr(args, 'schedule_window', 100),
+                     getattr(args, 'priority', 'scan'), on_batch=log_batch)
 
-def optimize_dir(args, client, currentdir, outdir, params, recursive):
-    files = list(scan_directory(args, currentdir, recursive))
 
-    if len(files) == 0:
-        print('No unoptimized files found.')
-        return
+def log_decision(args, path, decision, reason):
+    if reason is not None:
+        log_output(args, "Pre-filter: " + decision + " " + os.path.basename(path) + " (" + reason + ")",
+                   level="verbose")
 
-    total_count = len(files)
-    optimized_count = 0
-    total_saved = 0
-    total_size = 0
 
-    log_output(args, "Found total " + str(total_count) + " images", level="verbose")
-    for item in files:
-        file_name = os.path.basename(item)
-        if outdir is None or outdir == 0:
-            save_path = item
-        else:
-            if not os.path.isdir(outdir):
-                try:
-                    os.mkdir(outdir)
-                except OSError as exc:
-                    if exc.errno != errno.EEXIST:
-                        raise
-                    pass
-            save_path = outdir + os.sep + file_name
-        log_output(args, "Checking if the target path " + save_path + " is writable...", level="verbose")
-        if outdir is not None and not os.access(outdir, os.W_OK):
-            raise Exception("The save directory " + outdir + " is not writable :(")
+def start_callback_receiver(args):
+    listen = getattr(args, 'callback_listen', None)
+    if not listen:
+        return None
+    from megaoptim.client.callback import CallbackReceiver
+    host, _, port = listen.rpartition(':')
+    receiver = CallbackReceiver(host or '0.0.0.0', int(port), public_url=getattr(args, 'callback_url', None))
+    receiver.start()
+    log_output(args, "Listening for the optimization callbacks on " + listen, level="verbose")
+    return receiver
+
+
+def is_shared(args):
+    return bool(getattr(args, 'shard', None)) or getattr(args, 'leases', '0') == '1'
+
+
+def create_leases(args, manifest):
+    if getattr(args, 'leases', '0') != '1':
+        return None
+    from megaoptim.cli.coordination import Leases
+    return Leases(manifest, ttl=getattr(args, 'lease_ttl', 900))
+
+
+def optimize_dir(args, client, currentdir, outdir, params, recursive):
+    from megaoptim.cli.manifest import Manifest
+    with Manifest(get_manifest_path(args, currentdir), is_shared(args)) as manifest:
+        receiver = start_callback_receiver(args)
+        try:
+            optimize_files(args, client, manifest, currentdir, outdir, params, recursive, receiver)
+        finally:
+            if receiver is not None:
+                receiver.stop()
+
+
+def watch_dir(args, client, currentdir, outdir, params, recursive):
+    # Optimizes the directory once, then the images that are written to it until interrupted. The watcher is
+    # started first, so the images that arrive during the first run are not missed. The changed files are
+    # optimized once they are completely written, together with the others that settled at the same time, by the
+    # same client, so its connections stay open between the runs.
+    from megaoptim.cli.manifest import Manifest
+    from megaoptim.cli.watcher import Debouncer, create_watcher
+    settle = getattr(args, 'watch_settle', 2.0)
+    with Manifest(get_manifest_path(args, currentdir), is_shared(args)) as manifest:
+        receiver = start_callback_receiver(args)
+        watcher = create_watcher(currentdir, recursive, parse_exclude(getattr(args, 'exclude', None)),
+                                 interval=getattr(args, 'watch_interval', 5.0),
+                                 polling=getattr(args, 'watch_polling', '0') == '1')
+        try:
+            optimize_files(args, client, manifest, currentdir, outdir, params, recursive, receiver)
+            log_output(args, "Watching " + currentdir + " for new images (" + watcher.name + ")")
+            debouncer = Debouncer(settle)
+            while True:
+                for path in watcher.read(min(1.0, settle / 2.0) if settle > 0 else 1.0):
+                    debouncer.add(path, time.time())
+                ready = debouncer.ready(time.time())
+                if ready:
+                    log_output(args, str(len(ready)) + " changed files settled, " + str(debouncer.count()) +
+                               " still being written", level="verbose")
+                    # A failed run does not stop the watch, its unfinished jobs are resumed by the next one.
+                    try:
+                        optimize_files(args, client, manifest, currentdir, outdir, params, recursive, receiver,
+                                       ready)
+                    except Exception as e:
+                        log_output(args, "Failed to optimize the changed files: " + str(e))
+        except KeyboardInterrupt:
+            log_output(args, "Stopped watching " + currentdir)
+        finally:
+            watcher.close()
+            if receiver is not None:
+                receiver.stop()
+
+
+def read_resources(args, manifest, reader, checkpoint, totals):
+    # Yields the urls and the local images of the input list that were not optimized before. The resources that
+    # are skipped are finished right away, so the checkpoint moves past them. With --shard the local images are
+    # split by their path, like in a directory, and the urls by a hash of the url.
+    from megaoptim import validate_url
+    skip = create_skip(args, manifest, os.getcwd())
+    shard = None
+    if getattr(args, 'shard', None):
+        from megaoptim.cli.coordination import parse_shard, shard_of_key
+        shard = parse_shard(args.shard)
+    for start, end, resource in reader:
+        is_url = bool(validate_url(resource))
+        if not is_url:
+            resource = os.path.realpath(resource)
+        if checkpoint is not None:
+            checkpoint.started(resource, start, end)
+        if is_url:
+            skipped = (shard is not None and shard_of_key(resource, shard[1]) != shard[0]) or manifest.contains(
+                resource)
         else:
-            log_output(args, "Processing file " + os.path.basename(item))
-            r = client.optimize(item, params)
-            if r.get('status') == 'ok' and r.get('code') == 200:
-                # Loop through results array from the response to get optimization info for every image in the request
-                for ritem in r.get('result'):
-                    if ritem['saved_bytes'] <= 0:
-                        log_output(args, "Skipping. Already optimized, no need more optimization.")
-                        continue
-                    if ritem['url'] is None:
-                        log_output(args,"Failed to save file " + os.path.basename(item) + ": Missing optimization url.")
-                        continue
-                    ritem['old_path'] = item
-                    ritem['optimized_path'] = save_file(args, url=ritem['url'], save_path=save_path)
-                    if not ritem['optimized_path']:
-                        log_output(args, "Failed to optimize file " + os.path.basename(item))
-                    else:
-                        log_output(args, "File " + os.path.basename(item) + " successfully optimized.")
-                        ritem['date'] = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
-                        optimized_count = optimized_count + 1
-                        if ritem['saved_bytes'] <= 0:
-                            total_saved = 0
-                        else:
-                            total_saved += (ritem['saved_bytes'] / 1024) / 1024
-                        total_size += ritem['original_size']
-                        save_result(args, ritem)
-
-    overall_total_size = (total_size / 1024) / 1024
+            skipped = not os.path.isfile(resource) or skip(resource, os.stat(resource)) or sniff_image(
+                resource) is None
+        if skipped:
+            if checkpoint is not None:
+                checkpoint.finished(resource)
+            continue
+        totals['found_count'] += 1
+        yield resource
+
+
+def optimize_input(args, client, outdir, params):
+    # Optimizes the urls and paths listed in a file, or on the standard input with "-", as they are read. The
+    # urls are sent in requests of up to 5 urls and their optimized images are saved under outdir/host/path, the
+    # local images under outdir/path. The position in a file is checkpointed in the manifest of the outdir, so an
+    # interrupted run continues where it stopped. The checkpoint stays before the resources that failed, so the
+    # next run sends them again and skips the ones after them that were optimized.
+    import sys
+    from megaoptim.cli.inputs import Checkpoint, InputReader, input_save_path
+    from megaoptim.cli.manifest import Manifest
+    totals = {'optimized_count': 0, 'total_saved': 0, 'total_size': 0, 'found_count': 0, 'already_optimized': 0,
+              'failed_count': 0}
+    with Manifest(get_manifest_path(args, outdir), is_shared(args)) as manifest:
+        stream = None
+        checkpoint = None
+        try:
+            if args.input == '-':
+                stream = getattr(sys.stdin, 'buffer', sys.stdin)
+                offset = 0
+            else:
+                name = os.path.realpath(args.input)
+                checkpoint = Checkpoint(manifest, name)
+                offset = checkpoint.load(os.path.getsize(name))
+                stream = open(name, 'rb')
+                if offset > 0:
+                    log_output(args, "Resuming " + args.input + " from byte " + str(offset))
+                    stream.seek(offset)
+            reader = InputReader(stream, offset)
+            resources = announce_files(args, read_resources(args, manifest, reader, checkpoint, totals))
+
+            def on_failed(item):
+                totals['failed_count'] += 1
+
+            locate = lambda item: input_save_path(item, outdir)
+            batch_size = getattr(args, 'batch_size', 5)
+            workers = getattr(args, 'workers', 1)
+            if workers > 1:
+                results = optimize_parallel(args, client, resources, outdir, params, batch_size, workers,
+                                            locate=locate, on_failed=on_failed)
+            else:
+                results = optimize_sequential(args, client, resources, outdir, params, batch_size,
+                                              locate=locate, on_failed=on_failed)
+            for ritem in results:
+                record_result(args, manifest, ritem, totals)
+                if checkpoint is not None:
+                    checkpoint.finished(ritem['old_path'])
+            if checkpoint is not None:
+                checkpoint.advance(reader.offset)
+        finally:
+            if checkpoint is not None:
+                checkpoint.save()
+            if stream is not None and stream is not sys.stdin and stream is not getattr(sys.stdin, 'buffer', None):
+                stream.close()
+    log_concurrency(args, client)
+    if reader.invalid_count > 0:
+        log_output(args, "Skipped " + str(reader.invalid_count) + " invalid lines of " + args.input)
+    if totals['failed_count'] > 0:
+        log_output(args, "Failed to optimize " + str(totals['failed_count']) + " images, they are sent again by the "
+                                                                              "next run.")
+    log_output(args, "Input " + args.input + " successfully optimized!\n Total files count: " + str(
+        totals['optimized_count']) + " (" + str(round(totals['total_size'] / 1024.0 / 1024.0, 2)) +
+        " MB). Total space saved: " + str(round(totals['total_saved'], 2)) + " MB")
+
+
+def optimize_files(args, client, manifest, currentdir, outdir, params, recursive, receiver=None, paths=None):
+    # Optimizes the images found in the directory, or only the given changed paths in watch mode.
+    from megaoptim.cli.dedup import Deduplicator
+    from megaoptim.cli.journal import Journal
+    instrumentation = client.instrumentation
+    run_start = time.time()
+    totals = {'optimized_count': 0, 'total_saved': 0, 'total_size': 0, 'found_count': 0, 'already_optimized': 0}
+    if paths is None:
+        found = scan_directory(args, currentdir, recursive, manifest)
+    else:
+        found = select_files(args, manifest, currentdir, paths, outdir)
+    # With leases the files are claimed in the manifest, so the other processes optimizing the tree skip them.
+    # A file is checked again once claimed, in case another process finished it in the meantime.
+    leases = create_leases(args, manifest)
+    if leases is not None:
+        skip = create_skip(args, manifest, currentdir)
+        recheck = lambda path: not os.path.isfile(path) or skip(path, os.stat(path))
+        found = leases.filter(found, recheck)
+    files = count_files(args, timed_items(instrumentation, 'scan', found), totals)
+    prepare_outdir(args, outdir)
+
+    # Every job is journaled before its result is awaited. The jobs left by an interrupted run are finished
+    # and recorded first, so the scan that follows skips their images.
+    journal = Journal(manifest)
+    resumed = resume_jobs(args, client, manifest, journal, outdir, totals, leases,
+                          create_scope(args, currentdir, recursive))
+
+    # The low-yield images are skipped or deferred from their headers, before they are hashed or sent.
+    prefilter = create_prefilter(args, manifest)
+    if prefilter is not None:
+        files = prefilter.filter(files, lambda path, decision, reason: log_decision(args, path, decision, reason))
+
+    # Only one copy of every identical image is sent, the other copies get the same optimized file.
+    dedup = None
+    if getattr(args, 'dedup', '1') == '1':
+        dedup = Deduplicator(manifest, instrumentation)
+        files = dedup.filter(files)
+
+    # The images larger than the maximum size can be reduced before they are uploaded.
+    resizer = create_resizer(args, params)
+    prepare = resizer.prepare if resizer is not None else None
+
+    # The files are sent in multi-file requests of up to --batch-size images and --batch-bytes bytes, in the
+    # order of --priority.
+    batch_size = getattr(args, 'batch_size', 5)
+    scheduler = create_scheduler(args, batch_size)
+    batcher = scheduler.batches
+    if leases is not None:
+        # The claims are renewed when the batches are sent, the files can wait in the scheduler for long.
+        batcher = lambda files: leases.batches(scheduler.batches(files), recheck)
+    workers = getattr(args, 'workers', 1)
+    if workers > 1:
+        results = optimize_parallel(args, client, announce_files(args, files), outdir, params, batch_size, workers,
+                                    receiver, journal, prepare, batcher)
+    else:
+        results = optimize_sequential(args, client, announce_files(args, files), outdir, params, batch_size,
+                                      receiver, journal, prepare, batcher)
+    # This loop is the only writer of the results, so the manifest is never written concurrently.
+    for ritem in itertools.chain(resumed, results):
+        start = time.time()
+        duplicates = dedup.finish(ritem) if dedup is not None else []
+        record_result(args, manifest, ritem, totals)
+        record_duplicates(args, manifest, duplicates, outdir, totals)
+        if instrumentation is not None:
+            instrumentation.emit('record', start, path=ritem['old_path'], duplicates=len(duplicates))
+    if dedup is not None:
+        record_duplicates(args, manifest, dedup.take_ready(), outdir, totals)
+        if dedup.pending_count() > 0:
+            log_output(args, "Skipped " + str(dedup.pending_count()) + " identical copies of images that failed to "
+                                                                      "optimize.", level="verbose")
+    journal.finish_run()
+    if leases is not None:
+        leases.release_all()
+        if leases.busy_count > 0:
+            log_output(args, "Skipped " + str(leases.busy_count) + " images claimed by other processes.",
+                       level="verbose")
+    if instrumentation is not None:
+        instrumentation.emit('run', run_start, directory=currentdir, found=totals['found_count'],
+                             optimized=totals['optimized_count'])
+
+    if totals['found_count'] == 0:
+        if paths is None:
+            print('No unoptimized files found.')
+        return
+
+    overall_total_size = (totals['total_size'] / 1024) / 1024
     overall_total_size = round(overall_total_size, 2)
-    total_saved = round(total_saved, 2)
+    total_saved = round(totals['total_saved'], 2)
 
     log_output(args, "Directory " + currentdir + " successfully optimized!\n Total files count: " + str(
-        optimized_count) + " (" + str(overall_total_size) + " MB). Total space saved: " + str(
+        totals['optimized_count']) + " (" + str(overall_total_size) + " MB). Total space saved: " + str(
         total_saved) + " MB")
+    if totals['already_optimized'] > 0:
+        log_output(args, "Already optimized: " + str(totals['already_optimized']) + " files")
+    if prefilter is not None and prefilter.report() is not None:
+        log_output(args, "Pre-filter: " + prefilter.report())
+    if resizer is not None and resizer.resized_count > 0:
+        log_output(args, "Resized " + str(resizer.resized_count) + " images before uploading them, " + str(
+            round(resizer.saved_upload / 1024.0 / 1024.0, 2)) + " MB less uploaded.")
+    log_output(args, "Requests: " + str(client.stats.get('upload_requests')) + " uploads, " + str(
+        client.stats.get('result_requests')) + " result polls, " + str(client.stats.get('download_requests')) +
+        " downloads. Retries: " + str(client.stats.get('upload_retries')) + " uploads, " + str(
+        client.stats.get('result_retries')) + " result polls, " + str(client.stats.get('download_retries')) +
+        " downloads. Throttled: " + str(client.stats.get('throttled')), level="verbose")
+    log_concurrency(args, client)
+
+
+def create_instrumentation(args):
+    # The instrumentation is only created if one of its outputs was asked for, so the runs without them do not
+    # measure anything.
+    trace = getattr(args, 'trace', None)
+    collect = getattr(args, 'metrics', None) or getattr(args, 'timings', '0') == '1'
+    if not trace and not collect:
+        return None, None, None
+    from megaoptim.client.instrumentation import Instrumentation, JsonLinesTrace, MetricsCollector
+    instrumentation = Instrumentation()
+    trace = instrumentation.subscribe(JsonLinesTrace(trace)) if trace else None
+    metrics = instrumentation.subscribe(MetricsCollector()) if collect else None
+    return instrumentation, trace, metrics
+
+
+def log_concurrency(args, client):
+    if client.controller is None:
+        return
+    gauges = client.controller.snapshot()
+    log_output(args, "Concurrency limits: " + str(gauges['upload_limit']) + " uploads (peak " + str(
+        gauges['upload_peak']) + "), " + str(gauges['download_limit']) + " downloads (peak " + str(
+        gauges['download_peak']) + "), between " + str(client.controller.minimum) + " and " + str(
+        client.controller.maximum), level="verbose")
 
 
-def is_valid_image_old(path):
-    img = Image.open(path)
-    try:
-        img.verify()
-        return img.format in ['JPEG', 'JPEG2000', 'PNG', 'GIF']
-    except Exception:
-        return False
+def create_controller(args):
+    workers = getattr(args, 'workers', 1)
+    if getattr(args, 'adaptive', '0') != '1' or workers <= 1:
+        return None
+    from megaoptim.client.concurrency import ConcurrencyController
 
+    def log_change(kind, old, new, reason):
+        log_output(args, kind.capitalize() + " concurrency " + str(old) + " -> " + str(new) + " (" + reason + ")",
+                   level="verbose")
 
-def is_valid_image(path):
-    if os.path.isdir(path):
-        return False
-    _format = imghdr.what(path)
-    return _format in ['jpeg', 'png', 'gif']
+    return ConcurrencyController(min(max(1, args.min_workers), workers), workers, on_change=log_change)
+
+
+def export_metrics(args, client, trace, metrics):
+    if trace is not None:
+        trace.close()
+    if metrics is None:
+        return
+    if getattr(args, 'metrics', None):
+        with open(args.metrics, 'w') as f:
+            gauges = client.controller.snapshot() if client.controller is not None else None
+            f.write(metrics.prometheus(client.stats.snapshot(), gauges))
+    if getattr(args, 'timings', '0') == '1':
+        print(metrics.summary())
 
 
 def do():
     args = create_args()
     params = prepare_api_params(args)
 
+    import traceback
+    from megaoptim.client.client import Client
+    from megaoptim.client.retry import RetryPolicy
+
     api_key = None
 
     # The api key is required. Bail if empty!
@@ -338,14 +1191,30 @@ def do():
     else:
         outdir = None
 
+    if getattr(args, 'input', None) and outdir is None:
+        print('Please specify the --outdir to save the optimized images of the --input list to.')
+        exit()
+
     if 'recursive' in args and args.recursive == '0':
         recursive = False
     else:
         recursive = True
 
     try:
-        client = Client(api_key)
-        optimize_dir(args, client, working_dir, outdir, params, recursive)
+        retry_policy = RetryPolicy(max_retries=args.retries)
+        instrumentation, trace, metrics = create_instrumentation(args)
+        with Client(api_key, pool_maxsize=args.pool_size, download_chunk_size=args.download_chunk_size,
+                    rate_limit=args.rate_limit, retry_policy=retry_policy, api_base_url=args.api_url,
+                    instrumentation=instrumentation, controller=create_controller(args)) as client:
+            try:
+                if getattr(args, 'input', None):
+                    optimize_input(args, client, outdir, params)
+                elif getattr(args, 'watch', '0') == '1':
+                    watch_dir(args, client, working_dir, outdir, params, recursive)
+                else:
+                    optimize_dir(args, client, working_dir, outdir, params, recursive)
+            finally:
+                export_metrics(args, client, trace, metrics)
     except Exception as e:
         print(traceback.format_exc())
 
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+def parse_shard(value):
+    # Parses "i/N" into (i, N).
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except (AttributeError, ValueError):
+        raise Exception('The shard must be given as i/N, e.g. 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise Exception('The shard index must be between 0 and ' + str(count - 1))
+    return index, count
+
+
+def shard_of(path, root, count):
+    # The path relative to the root is hashed, so the hosts that mount the tree at different places agree on the
+    # shard of every file, and a file keeps its shard when other files are added.
+    return shard_of_key(os.path.relpath(path, root).replace(os.sep, '/'), count)
+
+
+def shard_of_key(key, count):
+    # The shard of a relative path or of a url.
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8', 'surrogateescape')
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % count
+
+
+class Leases(object):
+    # Claims the files in a table of the shared manifest, so several processes or hosts optimizing the same tree
+    # do not send the same image. A claim is a single statement, so it is atomic across the processes, and it
+    # expires after `ttl` seconds, so the files of a process that died are claimed by the others later on. The
+    # claims of a running process are renewed while it sends its batches, see batches().
+
+    def __init__(self, manifest, owner=None, ttl=900):
+        self.manifest = manifest
+        self.owner = owner or socket.gethostname() + ':' + str(os.getpid()) + ':' + uuid.uuid4().hex[:8]
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.busy_count = 0
+        self.renewed = time.time()
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS leases (path TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def claim(self, path):
+        # Returns True if the file was claimed, False if another owner holds a lease that did not expire.
+        now = time.time()
+        with self.manifest.lock:
+            with self.manifest.connection:
+                cursor = self.manifest.connection.execute(
+                    'INSERT OR REPLACE INTO leases (path, owner, expires) SELECT ?, ?, ? WHERE NOT EXISTS '
+                    '(SELECT 1 FROM leases WHERE path = ? AND owner != ? AND expires > ?)',
+                    (path, self.owner, now + self.ttl, path, self.owner, now))
+        if cursor.rowcount == 1:
+            return True
+        with self.lock:
+            self.busy_count += 1
+        return False
+
+    def claim_all(self, paths):
+        # Claims all the files or none of them.
+        claimed = []
+        for path in paths:
+            if not self.claim(path):
+                self.release(claimed)
+                return False
+            claimed.append(path)
+        return True
+
+    def renew_all(self):
+        # Extends all the claims of this owner, e.g. of the files deferred or waiting for an identical image.
+        now = time.time()
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute('UPDATE leases SET expires = ? WHERE owner = ?',
+                                                 (now + self.ttl, self.owner))
+        self.renewed = now
+
+    def release(self, paths):
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.executemany('DELETE FROM leases WHERE path = ? AND owner = ?',
+                                                     [(path, self.owner) for path in paths])
+
+    def release_all(self):
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute('DELETE FROM leases WHERE owner = ?', (self.owner,))
+
+    def filter(self, files, recheck=None):
+        # Yields the files that were claimed. recheck(path) is called after the claim and can reject a file that
+        # another process finished between the scan and the claim.
+        for path in files:
+            if not self.claim(path):
+                continue
+            if recheck is not None and recheck(path):
+                self.release([path])
+                continue
+            yield path
+
+    def batches(self, batches, recheck=None):
+        # Claims the files of every batch again right before it is sent, so a claim made by the scan that expired
+        # while the file waited in the scheduler is not sent by two processes. The files claimed by another
+        # process in the meantime, or rejected by recheck(path), are dropped from the batch. All the claims are
+        # renewed every quarter of the ttl while the batches are sent.
+        for batch in batches:
+            if time.time() - self.renewed > self.ttl / 4.0:
+                self.renew_all()
+            claimed = []
+            for path in batch:
+                if not self.claim(path):
+                    continue
+                if recheck is not None and recheck(path):
+                    self.release([path])
+                    continue
+                claimed.append(path)
+            if claimed:
+                yield tuple(claimed)
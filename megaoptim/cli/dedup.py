@@ -0,0 +1,70 @@
+import collections
+import threading
+import time
+
+from megaoptim.cli.manifest import file_hash
+from megaoptim.cli.records import PathTable, ResultRecord
+
+
+class Deduplicator(object):
+
+    def __init__(self, manifest, instrumentation=None, cache_size=1024):
+        self.manifest = manifest
+        self.instrumentation = instrumentation
+        # The files are filtered in the thread that feeds the uploads while the results are registered by the
+        # writer, so the state is guarded by a lock.
+        self.lock = threading.Lock()
+        self.representatives = {}
+        # The copies waiting for their representative are kept as interned (directory, name) pairs.
+        self.paths = PathTable()
+        self.duplicates = {}
+        # Only the last results are kept, the older ones are found in the manifest the writer saved them to.
+        self.results = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.ready = []
+
+    def filter(self, files):
+        # Yields only one representative per content hash. The other copies wait for the result of their
+        # representative, and the copies of images optimized in the previous runs are ready right away.
+        for path in files:
+            start = time.time()
+            digest = file_hash(path)
+            known = self.manifest.find_optimized(digest)
+            if self.instrumentation is not None:
+                self.instrumentation.emit('dedup', start, path=path)
+            with self.lock:
+                if known is not None:
+                    self.ready.append((path, digest, known))
+                    continue
+                if digest in self.results:
+                    self.ready.append((path, digest, self.results[digest].as_dict()))
+                    continue
+                if digest in self.duplicates:
+                    self.duplicates[digest].append(self.paths.add(path))
+                    continue
+                self.representatives[path] = digest
+                self.duplicates[digest] = []
+            yield path
+
+    def finish(self, ritem):
+        # Registers the result of a representative and returns the copies that can now be materialized
+        # from it, as (path, hash, source result) tuples.
+        with self.lock:
+            digest = self.representatives.pop(ritem['old_path'], None)
+            if digest is not None:
+                ritem['source_hash'] = digest
+                self.results[digest] = ResultRecord(ritem)
+                if len(self.results) > self.cache_size:
+                    self.results.popitem(last=False)
+                for key in self.duplicates.pop(digest, []):
+                    self.ready.append((self.paths.path(key), digest, ritem))
+        return self.take_ready()
+
+    def take_ready(self):
+        with self.lock:
+            ready, self.ready = self.ready, []
+        return ready
+
+    def pending_count(self):
+        with self.lock:
+            return sum(len(paths) for paths in self.duplicates.values())
@@ -0,0 +1,142 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    from urllib.parse import unquote, urlparse
+except ImportError:
+    from urllib import unquote
+    from urlparse import urlparse
+
+
+class InputReader(object):
+    # Reads the urls or paths of a list, one per line, without loading it into memory. A line can also be a JSON
+    # string or a JSON object with a "url" or "path" key. The empty lines and the lines starting with # are
+    # ignored, the invalid ones are counted. The stream is read in binary mode so the byte offset of every line is
+    # known and the reading can be resumed from a checkpoint.
+
+    def __init__(self, stream, offset=0):
+        self.stream = stream
+        self.offset = offset
+        self.invalid_count = 0
+
+    def __iter__(self):
+        # Yields (start, end, resource) with the byte offsets of the line of every resource.
+        for line in iter(self.stream.readline, b''):
+            start = self.offset
+            self.offset += len(line)
+            resource = self.parse(line)
+            if resource is not None:
+                yield start, self.offset, resource
+
+    def parse(self, line):
+        try:
+            text = line.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            self.invalid_count += 1
+            return None
+        if not text or text.startswith('#'):
+            return None
+        if not text.startswith('{') and not text.startswith('"'):
+            return text
+        try:
+            entry = json.loads(text)
+        except ValueError:
+            self.invalid_count += 1
+            return None
+        if isinstance(entry, dict):
+            entry = entry.get('url') or entry.get('path')
+        if not entry or not isinstance(entry, (type(u''), str)):
+            self.invalid_count += 1
+            return None
+        return entry
+
+
+class Checkpoint(object):
+    # Keeps the byte offset of the input list up to which every resource was finished, in a table of the
+    # manifest, so a run that is interrupted continues from there. The resources finish out of order, so the
+    # offset only moves past a resource once all the ones before it finished too. It is saved at most every
+    # `interval` seconds and when the run ends.
+
+    def __init__(self, manifest, name, interval=1.0):
+        self.manifest = manifest
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = collections.deque()
+        self.pending = {}
+        self.position = 0
+        self.saved_at = 0
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS inputs (name TEXT PRIMARY KEY, position INTEGER, updated REAL)')
+
+    def load(self, size=None):
+        # Returns the saved offset, or 0 if the list is now shorter than it, e.g. it was replaced.
+        with self.manifest.lock:
+            row = self.manifest.connection.execute('SELECT position FROM inputs WHERE name = ?',
+                                                   (self.name,)).fetchone()
+        position = row[0] if row is not None else 0
+        if size is not None and position > size:
+            position = 0
+        self.position = position
+        return position
+
+    def started(self, resource, start, end):
+        with self.lock:
+            entry = [start, end, False]
+            self.entries.append(entry)
+            self.pending.setdefault(resource, collections.deque()).append(entry)
+
+    def finished(self, resource):
+        with self.lock:
+            entries = self.pending.get(resource)
+            if not entries:
+                return
+            entries.popleft()[2] = True
+            if not entries:
+                del self.pending[resource]
+            while self.entries and self.entries[0][2]:
+                self.position = self.entries.popleft()[1]
+            save = time.time() - self.saved_at >= self.interval
+        if save:
+            self.save()
+
+    def advance(self, offset):
+        # Moves past the ignored lines read after the last resource once all the resources finished.
+        with self.lock:
+            if not self.entries:
+                self.position = max(self.position, offset)
+
+    def save(self):
+        with self.lock:
+            position = self.position
+            self.saved_at = time.time()
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute(
+                    'INSERT OR REPLACE INTO inputs (name, position, updated) VALUES (?, ?, ?)',
+                    (self.name, position, time.time()))
+
+
+def input_save_path(resource, outdir):
+    # Maps a url to outdir/host/path and a local path to the same path under outdir. The query string of a url
+    # is hashed into the file name, so the urls that differ only by it do not overwrite each other.
+    if '://' in resource:
+        parsed = urlparse(resource)
+        parts = [parsed.netloc.replace(':', '_')] + unquote(parsed.path).split('/')
+        query = parsed.query
+    else:
+        parts = os.path.splitdrive(os.path.realpath(resource))[1].split(os.sep)
+        query = None
+    parts = [part for part in parts if part not in ('', '.', '..')]
+    if len(parts) < 2:
+        parts.append('index')
+    if query:
+        name, extension = os.path.splitext(parts[-1])
+        parts[-1] = name + '-' + hashlib.md5(query.encode('utf-8')).hexdigest()[:8] + extension
+    return os.path.join(outdir, *parts)
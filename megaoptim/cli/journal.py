@@ -0,0 +1,87 @@
+import errno
+import json
+import os
+import socket
+import time
+import uuid
+
+from megaoptim import is_windows
+
+
+def process_owner():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+def is_stopped(owner):
+    # Tells if the process that recorded a job stopped: True or False for the processes of this host, None for the
+    # ones of the other hosts, which can not be checked. The jobs recorded before the owner was are from stopped
+    # runs, and the jobs of the earlier runs of this process are left over by a run that failed.
+    if owner is None or owner == process_owner():
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or is_windows():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return None
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class Journal(object):
+    # Records every submitted job in the manifest before its result is awaited, so a run that is killed can fetch
+    # the results of its jobs on the next start instead of uploading the images again. The jobs of a run are
+    # removed when the run finishes and the jobs left behind by an interrupted run once they are resumed. The
+    # owner of every job is recorded, so the jobs of the processes that still run are not taken over.
+
+    def __init__(self, manifest, run_id=None):
+        self.manifest = manifest
+        self.run_id = run_id or uuid.uuid4().hex
+        self.owner = process_owner()
+        with self.manifest.lock:
+            with self.manifest.connection:
+                # The column is added under the write lock, another process can be upgrading the table too.
+                self.manifest.connection.execute('BEGIN IMMEDIATE')
+                self.manifest.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS jobs (process_id TEXT PRIMARY KEY, run_id TEXT, sources TEXT, '
+                    'params TEXT, submitted REAL, owner TEXT)')
+                columns = [row[1] for row in self.manifest.connection.execute('PRAGMA table_info(jobs)')]
+                if 'owner' not in columns:
+                    self.manifest.connection.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+
+    def record(self, process_id, sources, params):
+        # The size and mtime of every source are kept, so a result is not applied to a file modified since.
+        entries = []
+        for path in sources:
+            stat = os.stat(path)
+            entries.append([path, stat.st_size, stat.st_mtime])
+        params = dict((key, value) for key, value in params.items() if key != 'callback_url')
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute(
+                    'INSERT OR REPLACE INTO jobs (process_id, run_id, sources, params, submitted, owner) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (process_id, self.run_id, json.dumps(entries), json.dumps(params), time.time(), self.owner))
+
+    def remove(self, process_id):
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute('DELETE FROM jobs WHERE process_id = ?', (process_id,))
+
+    def unfinished(self, max_age):
+        # Returns the (process_id, sources, owner) of the jobs left by the previous runs that are not older than
+        # max_age seconds. The older ones can not be fetched anymore and are dropped.
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute('DELETE FROM jobs WHERE submitted < ?', (time.time() - max_age,))
+            rows = self.manifest.connection.execute(
+                'SELECT process_id, sources, owner FROM jobs WHERE run_id != ? ORDER BY submitted',
+                (self.run_id,)).fetchall()
+        return [(process_id, json.loads(sources), owner) for process_id, sources, owner in rows]
+
+    def finish_run(self):
+        with self.manifest.lock:
+            with self.manifest.connection:
+                self.manifest.connection.execute('DELETE FROM jobs WHERE run_id = ?', (self.run_id,))
@@ -0,0 +1,235 @@
+import csv
+import hashlib
+import os
+import sqlite3
+import threading
+
+MANIFEST_NAME = '.megaoptim.db'
+LEGACY_NAME = '.megaoptim'
+
+COLUMNS = ['path', 'size', 'mtime', 'hash', 'optimized_path', 'original_size', 'optimized_size', 'saved_bytes',
+           'saved_percent', 'url', 'date', 'source_hash', 'optimized_hash',
+           'inode']
+
+
+def file_hash(path, chunk_size=1048576):
+    # Hashes the file in chunks so the memory stays flat regardless of the file size.
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(chunk_size)
+    return digest.hexdigest()
+
+
+def find_manifest(directory):
+    # Returns the manifest of the outermost parent directory that has one, so a run on a subdirectory skips the
+    # images recorded by the runs on its parents, or the path of a new manifest in the directory.
+    found = None
+    current = directory
+    while True:
+        path = os.path.join(current, MANIFEST_NAME)
+        if os.path.isfile(path):
+            found = path
+        parent = os.path.dirname(current)
+        if parent == current:
+            return found or os.path.join(directory, MANIFEST_NAME)
+        current = parent
+
+
+def modified_time(path):
+    # The changes of a manifest in WAL mode can be in its -wal file only.
+    times = [os.stat(name).st_mtime for name in (path, path + '-wal') if os.path.isfile(name)]
+    return max(times) if times else None
+
+
+def to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class Manifest(object):
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        # The connection is shared by the scanning and the writing threads, the lock serializes its use.
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # A manifest shared by several hosts uses the rollback journal, the WAL needs memory shared by the
+        # processes and does not work on network file systems.
+        self.connection.execute('PRAGMA journal_mode=' + ('DELETE' if shared else 'WAL'))
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # Several processes can open a new manifest at once, e.g. with --leases, so the schema is created and
+        # upgraded under the write lock and checked again once it is held.
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, '
+                'optimized_path TEXT, original_size INTEGER, optimized_size INTEGER, saved_bytes INTEGER, '
+                'saved_percent INTEGER, url TEXT, date TEXT, source_hash TEXT, optimized_hash TEXT, inode INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS migrated (path TEXT PRIMARY KEY, mtime REAL)')
+            self.upgrade()
+
+    def upgrade(self):
+        # Adds the columns that were introduced after the manifest was first created. Called with the write lock.
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(files)')]
+        for name in COLUMNS:
+            if name not in columns:
+                self.connection.execute('ALTER TABLE files ADD COLUMN ' + name)
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_source_hash ON files (source_hash)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_optimized_size ON files (optimized_size)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_optimized_hash ON files (optimized_hash)')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def contains(self, path):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM files WHERE path = ?', (path,)).fetchone()
+        return row is not None
+
+    def get(self, path):
+        with self.lock:
+            row = self.connection.execute('SELECT ' + ', '.join(COLUMNS) + ' FROM files WHERE path = ?',
+                                          (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def is_unchanged(self, path, stat, check_inode=False):
+        # Tells if the file was optimized before and was not modified since, using only the stat of the file.
+        # The records imported without a stat are trusted by path, like the legacy .megaoptim files were.
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime, inode FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return False
+        size, mtime, inode = row
+        if size is None or mtime is None:
+            return True
+        if check_inode and inode is not None and inode != stat.st_ino:
+            return False
+        return size == stat.st_size and mtime == stat.st_mtime
+
+    def find_optimized(self, source_hash):
+        # Returns a previous result of an image with the same content whose optimized file still exists unchanged,
+        # so it can be copied instead of being optimized again.
+        with self.lock:
+            rows = self.connection.execute('SELECT ' + ', '.join(COLUMNS) + ' FROM files WHERE source_hash = ? '
+                                           'AND optimized_hash IS NOT NULL', (source_hash,)).fetchall()
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            optimized_path = record['optimized_path']
+            if not optimized_path or not os.path.isfile(optimized_path):
+                continue
+            if file_hash(optimized_path) == record['optimized_hash']:
+                return record
+        return None
+
+    def is_optimized_file(self, path, size):
+        # Tells if the file is an output of a previous run, or an image the API reported as already optimized,
+        # wherever it was copied since. The file is only hashed if an optimized file of the same size is known.
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM files WHERE optimized_size = ? AND optimized_hash IS NOT NULL '
+                                          'LIMIT 1', (size,)).fetchone()
+        if row is None:
+            return False
+        digest = file_hash(path)
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM files WHERE optimized_hash = ? LIMIT 1', (digest,)).fetchone()
+        return row is not None
+
+    def save(self, result):
+        # The file at the original path is the one that is checked on the next run, so its current size, mtime
+        # and hash are stored together with the optimization result.
+        path = result['old_path']
+        stat, digest = None, None
+        if os.path.isfile(path):
+            stat, digest = os.stat(path), file_hash(path)
+        optimized_path = result.get('optimized_path')
+        if optimized_path == path:
+            result['optimized_hash'] = digest
+        elif optimized_path and os.path.isfile(optimized_path):
+            result['optimized_hash'] = file_hash(optimized_path)
+        with self.lock:
+            with self.connection:
+                self.insert(path, stat, digest, result)
+
+    def insert(self, path, stat, digest, result, conflict='REPLACE'):
+        size, mtime, inode = None, None, None
+        if stat is not None:
+            size, mtime, inode = stat.st_size, stat.st_mtime, stat.st_ino
+        self.connection.execute(
+            'INSERT OR ' + conflict + ' INTO files (' + ', '.join(COLUMNS) + ') VALUES (' +
+            ', '.join('?' * len(COLUMNS)) + ')',
+            (path, size, mtime, digest, result.get('optimized_path'), to_int(result.get('original_size')),
+             to_int(result.get('optimized_size')), to_int(result.get('saved_bytes')),
+             to_int(result.get('saved_percent')), result.get('url'), result.get('date'),
+             result.get('source_hash'), result.get('optimized_hash'), inode))
+
+    def migrate_directory(self, directory):
+        # Imports the legacy per-directory .megaoptim CSV file and the manifest of a run on the subdirectory that
+        # was made before its parent had one. A file is imported again only if it was changed since the last
+        # import, e.g. by an older version of the command line tool.
+        count = 0
+        legacy_path = directory + os.sep + LEGACY_NAME
+        if os.path.isfile(legacy_path):
+            legacy_mtime = os.stat(legacy_path).st_mtime
+            with self.lock:
+                count += self.migrate_file(legacy_path, legacy_mtime)
+        nested_path = directory + os.sep + MANIFEST_NAME
+        if os.path.isfile(nested_path) and os.path.realpath(nested_path) != os.path.realpath(self.path):
+            with self.lock:
+                count += self.migrate_manifest(nested_path, modified_time(nested_path))
+        return count
+
+    def migrate_file(self, legacy_path, legacy_mtime):
+        row = self.connection.execute('SELECT mtime FROM migrated WHERE path = ?', (legacy_path,)).fetchone()
+        if row is not None and row[0] == legacy_mtime:
+            return 0
+        count = 0
+        with self.connection:
+            with open(legacy_path, mode='r') as csv_file:
+                for result in csv.DictReader(csv_file):
+                    path = result.get('old_path')
+                    if not path:
+                        continue
+                    stat = os.stat(path) if os.path.isfile(path) else None
+                    # The records written by this manifest are newer than the legacy ones, so they are kept.
+                    self.insert(path, stat, None, result, conflict='IGNORE')
+                    count += 1
+            self.connection.execute('INSERT OR REPLACE INTO migrated (path, mtime) VALUES (?, ?)',
+                                    (legacy_path, legacy_mtime))
+        return count
+
+    def migrate_manifest(self, nested_path, nested_mtime):
+        row = self.connection.execute('SELECT mtime FROM migrated WHERE path = ?', (nested_path,)).fetchone()
+        if row is not None and row[0] == nested_mtime:
+            return 0
+        source = sqlite3.connect(nested_path, timeout=30)
+        try:
+            # The manifest can be older than this one and miss some of the columns.
+            columns = [row[1] for row in source.execute('PRAGMA table_info(files)')]
+            names = [name for name in COLUMNS if name in columns]
+            count = 0
+            with self.connection:
+                if names:
+                    # The records written by this manifest are newer than the imported ones, so they are kept.
+                    cursor = self.connection.executemany(
+                        'INSERT OR IGNORE INTO files (' + ', '.join(names) + ') VALUES (' +
+                        ', '.join('?' * len(names)) + ')',
+                        source.execute('SELECT ' + ', '.join(names) + ' FROM files'))
+                    count = max(0, cursor.rowcount)
+                self.connection.execute('INSERT OR REPLACE INTO migrated (path, mtime) VALUES (?, ?)',
+                                        (nested_path, nested_mtime))
+        finally:
+            source.close()
+        return count
@@ -0,0 +1,136 @@
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DONE = object()
+# Seconds a blocked thread waits before it checks again whether the pipeline was stopped.
+POLL_INTERVAL = 0.1
+
+
+class Pipeline(object):
+
+    def __init__(self, queue_size=10):
+        self.queue_size = queue_size
+        self.stages = []
+        self.errors = []
+        self.stopped = threading.Event()
+
+    def add_stage(self, func, workers=1):
+        # Every stage runs `workers` threads that take an item from the inbox of the stage and put every
+        # value yielded by func(item) into the inbox of the next stage. The inboxes are bounded so the
+        # number of items waiting between two stages never grows above `queue_size`.
+        self.stages.append((func, workers))
+        return self
+
+    def run(self, items):
+        # Feeds the items through the stages and yields the output of the last stage in the calling thread,
+        # so the consumer is the single owner of whatever it does with the results.
+        inboxes = [queue.Queue(self.queue_size) for _ in self.stages]
+        results = queue.Queue(self.queue_size)
+        outboxes = inboxes[1:] + [results]
+
+        threads = []
+        for i, (func, workers) in enumerate(self.stages):
+            next_workers = self.stages[i + 1][1] if i + 1 < len(self.stages) else 1
+            threads.append(self.start_stage(func, workers, inboxes[i], outboxes[i], next_workers))
+
+        feeder = threading.Thread(target=self.feed, args=(items, inboxes[0], self.stages[0][1]))
+        feeder.daemon = True
+        feeder.start()
+
+        finished = False
+        try:
+            while True:
+                result = results.get()
+                if result is DONE:
+                    break
+                yield result
+            finished = True
+        finally:
+            if not finished:
+                # The consumer stopped early, e.g. on an exception. The threads are told to stop and the queues
+                # are drained, so none of them stays blocked on a full queue with its files and connections.
+                self.stop(inboxes + [results])
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def stop(self, queues):
+        self.stopped.set()
+        for inbox in queues:
+            try:
+                while True:
+                    inbox.get_nowait()
+            except queue.Empty:
+                pass
+
+    def put(self, inbox, item):
+        # Returns False instead of blocking once the pipeline is stopped.
+        while not self.stopped.is_set():
+            try:
+                inbox.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, inbox):
+        # Returns DONE once the pipeline is stopped.
+        while not self.stopped.is_set():
+            try:
+                return inbox.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def feed(self, items, inbox, workers):
+        try:
+            for item in items:
+                if not self.put(inbox, item):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            # The items are produced in this thread, so their generator is closed here when the run stopped.
+            if self.stopped.is_set() and hasattr(items, 'close'):
+                items.close()
+            for _ in range(workers):
+                self.put(inbox, DONE)
+
+    def start_stage(self, func, workers, inbox, outbox, next_workers):
+        threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work, args=(func, inbox, outbox))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Once every worker of the stage has finished, the next stage is told that no more items will come.
+        def close():
+            for thread in threads:
+                thread.join()
+            for _ in range(next_workers):
+                self.put(outbox, DONE)
+
+        closer = threading.Thread(target=close)
+        closer.daemon = True
+        closer.start()
+        return closer
+
+    def work(self, func, inbox, outbox):
+        while True:
+            item = self.get(inbox)
+            if item is DONE:
+                break
+            try:
+                for result in func(item):
+                    if not self.put(outbox, result):
+                        break
+            except Exception as e:
+                self.errors.append(e)
@@ -0,0 +1,182 @@
+import os
+import struct
+import threading
+
+# The luminance quantization table of the JPEG standard (Annex K), that encoders scale by the quality setting.
+STANDARD_LUMINANCE = (16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55, 14, 13, 16, 24, 40, 57, 69, 56,
+                      14, 17, 22, 29, 51, 87, 80, 62, 18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113,
+                      92, 49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99)
+JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+# The PNG chunks needed to decode the image, all the others are metadata the API can strip.
+PNG_CRITICAL_CHUNKS = (b'IHDR', b'PLTE', b'IDAT', b'IEND', b'tRNS')
+PNG_MAX_CHUNKS = 100000
+
+SEND = 'send'
+SKIP = 'skip'
+DEFER = 'defer'
+
+
+def estimate_jpeg_quality(table):
+    # Inverts the IJG scaling of the standard table. The sums are compared, so the order of the table does not
+    # matter and the tables of the other encoders give a rough estimate too.
+    scale = 100.0 * sum(table) / sum(STANDARD_LUMINANCE)
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return int(round(max(1, min(100, quality))))
+
+
+def read_jpeg_info(f):
+    # Reads the segments up to the start of the scan. Returns the size, the luminance quality estimate and the
+    # number of bytes taken by the metadata segments (APP1-APP15 and comments).
+    if f.read(2) != b'\xff\xd8':
+        return None
+    info = {'format': 'jpeg', 'width': None, 'height': None, 'quality': None, 'metadata': 0}
+    while True:
+        if f.read(1) != b'\xff':
+            break
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            break
+        marker = ord(marker)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        if marker in (0xD9, 0xDA):
+            break
+        length = f.read(2)
+        if len(length) < 2:
+            break
+        length = struct.unpack('>H', length)[0]
+        if length < 2:
+            break
+        if marker == 0xDB:
+            data = bytearray(f.read(length - 2))
+            position = 0
+            while position < len(data):
+                precision, table_id = data[position] >> 4, data[position] & 0x0F
+                values = data[position + 1:position + 1 + 64 * (precision + 1)]
+                if precision:
+                    values = [values[i] << 8 | values[i + 1] for i in range(0, len(values) - 1, 2)]
+                if table_id == 0 and len(values) == 64:
+                    info['quality'] = estimate_jpeg_quality(values)
+                position += 1 + 64 * (precision + 1)
+        elif marker in JPEG_SOF_MARKERS:
+            data = f.read(length - 2)
+            if len(data) >= 5:
+                info['height'], info['width'] = struct.unpack('>HH', data[1:5])
+        else:
+            if 0xE1 <= marker <= 0xEF or marker == 0xFE:
+                info['metadata'] += length + 2
+            f.seek(length - 2, 1)
+    return info
+
+
+def read_png_info(f):
+    # Walks the chunk headers without reading the image data. Returns the size, the color type and the number of
+    # bytes taken by the ancillary chunks.
+    if f.read(8) != b'\x89PNG\r\n\x1a\n':
+        return None
+    info = {'format': 'png', 'width': None, 'height': None, 'color_type': None, 'metadata': 0}
+    for _ in range(PNG_MAX_CHUNKS):
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IHDR':
+            data = f.read(length)
+            if len(data) >= 10:
+                info['width'], info['height'], _, info['color_type'] = struct.unpack('>IIBB', data[:10])
+            f.seek(4, 1)
+            continue
+        if chunk_type == b'IEND':
+            break
+        if chunk_type not in PNG_CRITICAL_CHUNKS:
+            info['metadata'] += length + 12
+        f.seek(length + 4, 1)
+    return info
+
+
+def read_image_info(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(8)
+            f.seek(0)
+            if header.startswith(b'\xff\xd8'):
+                return read_jpeg_info(f)
+            if header.startswith(b'\x89PNG'):
+                return read_png_info(f)
+    except (IOError, OSError, struct.error):
+        pass
+    return None
+
+
+class Prefilter(object):
+    # Decides from the headers of every image if it is worth sending. The images that were produced by a previous
+    # run are always skipped. A JPEG saved at a low quality or with few bytes per pixel, and a PNG that is already
+    # palette based or has few bytes per pixel, are low-yield unless they carry metadata the API would strip.
+    # The low-yield images are skipped, or deferred after all the others when `defer` is set.
+
+    def __init__(self, manifest, keep_exif='0', jpeg_quality=75, jpeg_bpp=0.1, png_bpp=0.3, metadata_bytes=4096,
+                 defer=False):
+        self.manifest = manifest
+        self.keep_exif = keep_exif
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_bpp = jpeg_bpp
+        self.png_bpp = png_bpp
+        self.metadata_bytes = metadata_bytes
+        self.defer = defer
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def analyze(self, path):
+        # Returns the (decision, reason) for the image.
+        size = os.path.getsize(path)
+        if self.manifest.is_optimized_file(path, size):
+            return SKIP, 'known optimized'
+        low = DEFER if self.defer else SKIP
+        info = read_image_info(path)
+        if info is None or not info['width'] or not info['height']:
+            return SEND, None
+        if info['metadata'] >= self.metadata_bytes and self.keep_exif != '1':
+            return SEND, None
+        bpp = float(size) / (info['width'] * info['height'])
+        if info['format'] == 'jpeg':
+            if info['quality'] is not None and info['quality'] <= self.jpeg_quality:
+                return low, 'jpeg quality'
+            if bpp < self.jpeg_bpp:
+                return low, 'jpeg bytes per pixel'
+        elif info['format'] == 'png':
+            if info['color_type'] == 3:
+                return low, 'png palette'
+            if bpp < self.png_bpp:
+                return low, 'png bytes per pixel'
+        return SEND, None
+
+    def count(self, decision, reason):
+        key = decision if reason is None else decision + ': ' + reason
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def filter(self, files, on_decision=None):
+        # Yields the images to send, the deferred ones once all the others were yielded.
+        from megaoptim.cli.records import PathTable
+        paths = PathTable()
+        deferred = []
+        for path in files:
+            decision, reason = self.analyze(path)
+            self.count(decision, reason)
+            if on_decision is not None:
+                on_decision(path, decision, reason)
+            if decision == SEND:
+                yield path
+            elif decision == DEFER:
+                deferred.append(paths.add(path))
+        for key in deferred:
+            yield paths.path(key)
+
+    def report(self):
+        with self.lock:
+            counts = dict(self.counts)
+        if not counts:
+            return None
+        return ', '.join(key + ' ' + str(counts[key]) for key in sorted(counts))
@@ -0,0 +1,35 @@
+import os
+
+
+class PathTable(object):
+    # Keeps the paths as (directory id, file name) pairs. Every directory is stored once, so the million files of
+    # a thousand directories keep a thousand directory strings instead of a million full paths.
+
+    def __init__(self):
+        self.directories = []
+        self.ids = {}
+
+    def add(self, path):
+        directory, name = os.path.split(path)
+        index = self.ids.get(directory)
+        if index is None:
+            index = self.ids[directory] = len(self.directories)
+            self.directories.append(directory)
+        return index, name
+
+    def path(self, key):
+        return os.path.join(self.directories[key[0]], key[1])
+
+
+class ResultRecord(object):
+    # The fields of an optimization result that are needed to record the copies of the image, without the rest of
+    # the API response.
+    __slots__ = ('optimized_path', 'original_size', 'optimized_size', 'saved_bytes', 'saved_percent', 'url',
+                 'source_hash', 'optimized_hash', 'already_optimized')
+
+    def __init__(self, ritem):
+        for name in self.__slots__:
+            setattr(self, name, ritem.get(name))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
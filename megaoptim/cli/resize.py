@@ -0,0 +1,91 @@
+import io
+import os
+import threading
+
+
+class ResizedImage(io.BytesIO):
+    # In-memory copy of a resized image. It is named after the original, so it is uploaded with the same file name.
+
+    def __init__(self, name):
+        io.BytesIO.__init__(self)
+        self.name = name
+
+
+def fit_size(width, height, max_width, max_height):
+    # Returns the size the image is reduced to, or None if it already fits. When both limits are set the less
+    # restrictive one is applied, so the local copy is never smaller than what the API would produce from it.
+    scales = []
+    if max_width > 0:
+        scales.append(float(max_width) / width)
+    if max_height > 0:
+        scales.append(float(max_height) / height)
+    if not scales:
+        return None
+    scale = max(scales)
+    if scale >= 1:
+        return None
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+class Resizer(object):
+    # Reduces the JPEG and PNG images that are larger than max_width/max_height before they are uploaded. Pillow
+    # reads only the header to get the size, and the JPEGs are decoded directly at a reduced DCT scale by
+    # thumbnail(), so the full resolution image is never decoded. The resized copies are kept in memory.
+
+    def __init__(self, max_width, max_height, keep_exif='0', jpeg_quality=95):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise Exception('Resizing the images locally requires Pillow. Install it with: '
+                            'pip install megaoptim[images]')
+        self.image_module = Image
+        self.max_width = int(max_width or 0)
+        self.max_height = int(max_height or 0)
+        self.keep_exif = keep_exif
+        self.jpeg_quality = jpeg_quality
+        self.lock = threading.Lock()
+        self.resized_count = 0
+        self.saved_upload = 0
+
+    def resize(self, path):
+        # Returns the resized copy of the image, or None if it is sent as it is.
+        Image = self.image_module
+        try:
+            image = Image.open(path)
+        except Exception:
+            return None
+        try:
+            image_format = image.format
+            if image_format not in ('JPEG', 'PNG'):
+                return None
+            size = fit_size(image.size[0], image.size[1], self.max_width, self.max_height)
+            if size is None:
+                return None
+            info = dict(image.info)
+            image.thumbnail(size, Image.LANCZOS)
+            options = {}
+            if info.get('icc_profile'):
+                options['icc_profile'] = info['icc_profile']
+            if self.keep_exif == '1' and info.get('exif'):
+                options['exif'] = info['exif']
+            if image_format == 'JPEG':
+                options['quality'] = self.jpeg_quality
+            output = ResizedImage(path)
+            image.save(output, image_format, **options)
+        except Exception:
+            return None
+        finally:
+            image.close()
+        original_size = os.path.getsize(path)
+        resized_size = output.tell()
+        if resized_size >= original_size:
+            return None
+        output.seek(0)
+        with self.lock:
+            self.resized_count += 1
+            self.saved_upload += original_size - resized_size
+        return output
+
+    def prepare(self, batch):
+        # Returns the resources to upload for the batch: the resized copies and the paths of the other images.
+        return tuple(self.resize(path) or path for path in batch)
@@ -0,0 +1,88 @@
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+
+def sniff_image(path):
+    # Detects the supported image formats by their magic bytes with a single small read.
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(8)
+    except (IOError, OSError):
+        return None
+    for signature, _format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return _format
+    return None
+
+
+def verify_image(path):
+    # Decodes the whole image with Pillow, which is imported only when the verification is asked for.
+    try:
+        from PIL import Image
+    except ImportError:
+        raise Exception('Verifying the images requires Pillow. Install it with: pip install megaoptim[images]')
+    try:
+        image = Image.open(path)
+        try:
+            image.verify()
+            return image.format in ('JPEG', 'PNG', 'GIF')
+        finally:
+            image.close()
+    except Exception:
+        return False
+
+
+def parse_exclude(value):
+    if value is None or value == '0':
+        return set()
+    return set(os.path.realpath(path.strip()) for path in value.split(',') if path.strip())
+
+
+def scan_images(treeroot, recursive=True, exclude=None, skip=None, on_directory=None):
+    # Walks the tree lazily and yields (path, stat) for every image. The type of the directory entries is used
+    # to tell files from directories without extra stats, the excluded directories are pruned with their whole
+    # subtree, and skip(path, stat) can reject a file before it is opened to sniff its format. The treeroot and
+    # the excluded paths are expected to be real paths, the symlinked directories are not followed.
+    exclude = exclude or set()
+    stack = [treeroot]
+    while stack:
+        directory = stack.pop()
+        if on_directory is not None:
+            on_directory(directory)
+        try:
+            entries = scandir(directory)
+        except OSError:
+            continue
+        subdirectories = []
+        try:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and entry.path not in exclude:
+                            subdirectories.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if skip is not None and skip(entry.path, stat):
+                    continue
+                if sniff_image(entry.path) is not None:
+                    yield entry.path, stat
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+        # The subdirectories are pushed in reverse so they are visited in the order they were listed.
+        stack.extend(reversed(subdirectories))
@@ -0,0 +1,89 @@
+import heapq
+import itertools
+import os
+
+PRIORITIES = ('scan', 'newest', 'oldest', 'smallest', 'largest')
+
+
+class Scheduler(object):
+    # Orders the files by priority and packs them into the multi-file requests. A lookahead window of files is
+    # kept in two heaps, the large files (above half the byte budget) that are sent alone and the small ones that
+    # are packed up to batch_size files and byte_budget bytes. The batches alternate between the two, so the
+    # uploads running at the same time are not all stuck on large files. Every file is stat()ed once for its size
+    # and mtime, and only the window is kept in memory.
+
+    def __init__(self, batch_size=5, byte_budget=0, window=100, priority='scan', on_batch=None):
+        if priority not in PRIORITIES:
+            raise Exception('The priority must be one of: ' + ', '.join(PRIORITIES))
+        self.batch_size = batch_size
+        self.byte_budget = byte_budget
+        self.window = window
+        self.priority = priority
+        self.on_batch = on_batch
+        self.counter = itertools.count()
+        self.large = []
+        self.small = []
+        self.large_turn = True
+
+    def key(self, size, mtime):
+        # The heaps pop the lowest key first, the counter keeps the scan order between equal keys.
+        order = next(self.counter)
+        if self.priority == 'newest':
+            return -mtime, order
+        if self.priority == 'oldest':
+            return mtime, order
+        if self.priority == 'smallest':
+            return size, order
+        if self.priority == 'largest':
+            return -size, order
+        return order,
+
+    def push(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        entry = (self.key(stat.st_size, stat.st_mtime), stat.st_size, path)
+        if self.byte_budget > 0 and stat.st_size * 2 > self.byte_budget:
+            heapq.heappush(self.large, entry)
+        else:
+            heapq.heappush(self.small, entry)
+
+    def pending(self):
+        return len(self.large) + len(self.small)
+
+    def next_batch(self):
+        # Alternates between a large file and a pack of small files, falling back to whichever is left.
+        use_large = self.large and (self.large_turn or not self.small)
+        self.large_turn = not self.large_turn
+        if use_large:
+            _, size, path = heapq.heappop(self.large)
+            return (path,), size
+        batch, total, skipped = [], 0, []
+        # The files that do not fit the budget are put back, a few are tried so a batch is not closed too early.
+        while self.small and len(batch) < self.batch_size and len(skipped) < self.batch_size * 2:
+            entry = heapq.heappop(self.small)
+            if batch and self.byte_budget > 0 and total + entry[1] > self.byte_budget:
+                skipped.append(entry)
+                continue
+            batch.append(entry[2])
+            total += entry[1]
+        for entry in skipped:
+            heapq.heappush(self.small, entry)
+        return tuple(batch), total
+
+    def batches(self, files):
+        # Yields the batches while the files are still being found, keeping `window` files to choose from. With a
+        # window of 0 all the files are read before the first batch.
+        for path in files:
+            self.push(path)
+            if 0 < self.window <= self.pending():
+                yield self.emit()
+        while self.pending():
+            yield self.emit()
+
+    def emit(self):
+        batch, size = self.next_batch()
+        if self.on_batch is not None:
+            self.on_batch(batch, size)
+        return batch
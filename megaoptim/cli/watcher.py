@@ -0,0 +1,246 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import stat as stat_module
+import struct
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+# The inotify constants of <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 65536
+
+
+def encode_path(path):
+    if str is bytes:
+        return path
+    return os.fsencode(path)
+
+
+def decode_name(name):
+    if str is bytes:
+        return name
+    return os.fsdecode(name)
+
+
+def walk_directories(directory, recursive=True, exclude=None):
+    # Yields the directory and, if recursive, its subdirectories without the excluded ones and the symlinks.
+    exclude = exclude or set()
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        yield current
+        if not recursive:
+            continue
+        try:
+            entries = list(scandir(current))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False) and entry.path not in exclude:
+                    stack.append(entry.path)
+            except OSError:
+                continue
+
+
+def list_files(directory):
+    # Returns the (path, stat) of the regular files of the directory.
+    files = []
+    try:
+        entries = list(scandir(directory))
+    except OSError:
+        return files
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False):
+                files.append((entry.path, entry.stat()))
+        except OSError:
+            continue
+    return files
+
+
+class InotifyWatcher(object):
+    # Watches every directory of the tree with inotify. read() returns the files that were written, moved in or
+    # changed their attributes. The directories created or moved into the tree are watched too, and the files
+    # they already contain are returned since their events were missed. When the kernel queue overflowed the
+    # whole tree is returned.
+
+    name = 'inotify'
+
+    def __init__(self, directory, recursive=True, exclude=None):
+        library = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise Exception('inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directory = directory
+        self.recursive = recursive
+        self.exclude = exclude or set()
+        self.watches = {}
+        try:
+            self.add_tree(directory)
+        except Exception:
+            self.close()
+            raise
+
+    def add_tree(self, directory):
+        # Watches the directory and its subdirectories, and returns the files they already contain.
+        files = []
+        for current in walk_directories(directory, self.recursive, self.exclude):
+            wd = self.libc.inotify_add_watch(self.fd, encode_path(current), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if current == directory == self.directory or error == 28:
+                    # 28 is ENOSPC, the fs.inotify.max_user_watches limit was reached.
+                    raise OSError(error, 'inotify_add_watch failed for ' + current)
+                continue
+            self.watches[wd] = current
+            files.extend(path for path, _ in list_files(current))
+        return files
+
+    def read(self, timeout):
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError:
+            return changed
+        position = 0
+        while position + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, position)
+            name = data[position + EVENT_HEADER.size:position + EVENT_HEADER.size + length].rstrip(b'\0')
+            position += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                for current in walk_directories(self.directory, self.recursive, self.exclude):
+                    changed.update(path for path, _ in list_files(current))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, decode_name(name))
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO) and path not in self.exclude:
+                    try:
+                        changed.update(self.add_tree(path))
+                    except OSError:
+                        pass
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    # Compares snapshots of the size and mtime of every file of the tree, taken every `interval` seconds. Used
+    # where inotify is not available or does not see the changes, e.g. on network file systems.
+
+    name = 'polling'
+
+    def __init__(self, directory, recursive=True, exclude=None, interval=5.0):
+        self.directory = directory
+        self.recursive = recursive
+        self.exclude = exclude or set()
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+        self.next_poll = time.time() + interval
+
+    def take_snapshot(self):
+        # The files are grouped by directory, so every directory path is stored once.
+        snapshot = {}
+        for current in walk_directories(self.directory, self.recursive, self.exclude):
+            snapshot[current] = dict((os.path.basename(path), (stat.st_size, stat.st_mtime))
+                                     for path, stat in list_files(current))
+        return snapshot
+
+    def read(self, timeout):
+        delay = self.next_poll - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        if delay > 0:
+            time.sleep(delay)
+        snapshot = self.take_snapshot()
+        changed = set()
+        for directory, files in snapshot.items():
+            previous = self.snapshot.get(directory, {})
+            changed.update(os.path.join(directory, name) for name, signature in files.items()
+                           if previous.get(name) != signature)
+        self.snapshot = snapshot
+        self.next_poll = time.time() + self.interval
+        return changed
+
+    def close(self):
+        self.snapshot = {}
+
+
+def create_watcher(directory, recursive=True, exclude=None, interval=5.0, polling=False):
+    # Uses inotify where it is available and falls back to polling, e.g. on other systems or when the limit of
+    # watches is reached.
+    if not polling:
+        try:
+            return InotifyWatcher(directory, recursive, exclude)
+        except Exception:
+            pass
+    return PollingWatcher(directory, recursive, exclude, interval)
+
+
+class Debouncer(object):
+    # Holds the changed files until they are completely written: a file is ready once its size and mtime did not
+    # change for `settle` seconds. Every new event of a file starts its wait again.
+
+    def __init__(self, settle=2.0):
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, path, now):
+        self.pending[path] = (None, now)
+
+    def ready(self, now):
+        ready = []
+        for path, (signature, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if not stat_module.S_ISREG(stat.st_mode):
+                del self.pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime)
+            if current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle:
+                ready.append(path)
+                del self.pending[path]
+        return sorted(ready)
+
+    def count(self):
+        return len(self.pending)
@@ -0,0 +1,201 @@
+# coding=utf-8
+import asyncio
+import os.path
+import time
+
+from megaoptim import *
+from megaoptim.client.multipart import Source
+from megaoptim.client.retry import RateLimiter, RequestStats, RetryPolicy, DOWNLOAD, RESULT, UPLOAD
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncClient(object):
+
+    def __init__(self, api_key=None, concurrency=100, pool_maxsize=100, keep_alive=True, download_chunk_size=1048576,
+                 rate_limit=None, rate_burst=None, retry_policy=None, api_base_url='https://api.megaoptim.com/v1/',
+                 instrumentation=None):
+        if api_key is None:
+            raise Exception('Please provide MegaOptim.com API key')
+        if aiohttp is None:
+            raise Exception('The AsyncClient requires aiohttp. Install it with: pip install megaoptim[async]')
+        self.api_key = api_key
+        self.api_base_url = api_base_url.rstrip('/') + '/'
+        self.api_optimize_url = self.api_base_url + 'optimize'
+        self.api_user_agent = 'MegaOptim Python Client v1.0.0'
+        self.api_headers = {'User-Agent': self.api_user_agent, 'X-API-KEY': self.api_key}
+        self.concurrency = concurrency
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.download_chunk_size = download_chunk_size
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst) if rate_limit else None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.stats = RequestStats()
+        self.instrumentation = instrumentation
+        self._session = None
+        self._semaphore = None
+
+    def get_session(self):
+        # The session and the semaphore are bound to the running event loop, so they are created on first use.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize, limit_per_host=self.pool_maxsize,
+                                             force_close=not self.keep_alive)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def emit(self, name, start, **fields):
+        if self.instrumentation is not None:
+            self.instrumentation.emit(name, start, **fields)
+
+    async def request(self, kind, method, url, data_factory=None, **kwargs):
+        # Same retry and rate limiting rules as Client.request. The form data of aiohttp can be sent only
+        # once, so the uploads pass a factory that builds it for every attempt.
+        session = self.get_session()
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None and kind != DOWNLOAD:
+                waited = self.rate_limiter.reserve()
+                if waited > 0:
+                    self.stats.increment('throttled')
+                    await asyncio.sleep(waited)
+            if data_factory is not None:
+                kwargs['data'] = data_factory()
+            self.stats.increment(kind + '_requests')
+            start = time.time()
+            try:
+                r = await session.request(method, url, **kwargs)
+            except Exception as e:
+                if not self.retry_policy.should_retry(kind, attempt, error=e):
+                    raise
+                delay = self.retry_policy.get_delay(attempt)
+                self.emit('retry', start, kind=kind, attempt=attempt, delay=delay, error=type(e).__name__)
+            else:
+                if not self.retry_policy.should_retry(kind, attempt, status=r.status):
+                    return r
+                delay = self.retry_policy.get_delay(attempt, r.headers.get('Retry-After'))
+                self.emit('retry', start, kind=kind, attempt=attempt, delay=delay, status=r.status)
+                r.release()
+            self.stats.increment(kind + '_retries')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_result(self, job_id, timeout=300):
+        if job_id is None:
+            raise Exception('Please provide valid MegaOptim process id. Process ID is returned after you call the '
+                            '/optimize endpoint and your job has been queued for processing.')
+        results_endpoint = self.api_optimize_url + '/' + job_id + '/result?timeout=' + str(timeout)
+
+        self.get_session()
+        async with self._semaphore:
+            start = time.time()
+            try:
+                r = await self.request(RESULT, 'POST', results_endpoint, headers=self.api_headers)
+            except Exception as e:
+                self.emit('result', start, process_id=job_id, timeout=timeout, error=type(e).__name__)
+                raise
+            async with r:
+                self.emit('result', start, process_id=job_id, timeout=timeout, status=r.status)
+                return await self.parse_response(r)
+
+    async def send(self, resource=None, params=None):
+        _type, fields = classify_resource(resource)
+        params = prepare_params(params)
+        params['type'] = _type
+
+        sources = []
+        try:
+            if requires_upload(_type):
+                for name, resource in fields.items():
+                    sources.append((name, resource, Source(resource)))
+            else:
+                params.update(fields)
+
+            def create_form():
+                # aiohttp closes the files it sent, so it gets wrappers that leave them open for the next attempt
+                # and the caller. The local images are closed at the end.
+                data = aiohttp.FormData()
+                for name, value in params.items():
+                    data.add_field(name, str(value))
+                for name, resource, source in sources:
+                    source.rewind()
+                    data.add_field(name, source.payload(), filename=resource_name(resource) or name)
+                return data
+
+            self.get_session()
+            async with self._semaphore:
+                start = time.time()
+                try:
+                    r = await self.request(UPLOAD, 'POST', self.api_optimize_url, data_factory=create_form,
+                                           headers=self.api_headers)
+                except Exception as e:
+                    self.emit('upload', start, files=len(fields), error=type(e).__name__)
+                    raise
+                async with r:
+                    self.emit('upload', start, files=len(fields), status=r.status)
+                    return await self.parse_response(r)
+        finally:
+            for name, resource, source in sources:
+                source.close()
+
+    async def download(self, url, save_path, expected_size=None):
+        # Like Client.download, the file is written to a temporary file that replaces the target when complete.
+        if os.path.isdir(save_path):
+            return False
+        fd, temp_path = create_temp_file(save_path)
+        start = time.time()
+        written = 0
+        try:
+            self.get_session()
+            with os.fdopen(fd, 'wb') as f:
+                async with self._semaphore:
+                    async with await self.request(DOWNLOAD, 'GET', url) as r:
+                        if r.status >= 400:
+                            remove_temp_file(temp_path)
+                            self.emit('download', start, url=url, bytes=0, status=r.status, error='status')
+                            return False
+                        async for chunk in r.content.iter_chunked(self.download_chunk_size):
+                            f.write(chunk)
+                            written += len(chunk)
+            if expected_size is not None and written != int(expected_size):
+                remove_temp_file(temp_path)
+                self.emit('download', start, url=url, bytes=written, status=r.status, error='size')
+                return False
+            commit_temp_file(temp_path, save_path)
+        except Exception as e:
+            remove_temp_file(temp_path)
+            self.emit('download', start, url=url, bytes=written, error=type(e).__name__)
+            raise
+        self.emit('download', start, url=url, bytes=written, status=r.status)
+        return os.path.exists(save_path)
+
+    async def optimize(self, resource, params, timeout=300):
+        result = await self.send(resource, params)
+        if result.get('status') == 'processing':
+            if 'callback_url' in params and params['callback_url'] is not None:
+                return result
+            else:
+                process_id = result.get('process_id')
+                return await self.get_result(process_id, timeout)
+        else:
+            raise Exception(result.get('errors'))
+
+    async def parse_response(self, r):
+        try:
+            return await r.json(content_type=None)
+        except Exception as e:
+            raise Exception('Failed to parse JSON response from MegaOptim.com API')
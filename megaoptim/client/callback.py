@@ -0,0 +1,143 @@
+# coding=utf-8
+import json
+import threading
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+class CallbackServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        url = urlparse(self.path)
+        token = parse_qs(url.query).get('token', [None])[0]
+        if url.path != receiver.path or token != receiver.token:
+            return self.reply(403, {'status': 'error', 'errors': ['Invalid callback url']})
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        try:
+            payload = self.parse_body(body)
+        except ValueError:
+            return self.reply(400, {'status': 'error', 'errors': ['Invalid callback payload']})
+        if payload.get('id') is None:
+            return self.reply(400, {'status': 'error', 'errors': ['Missing process id']})
+        receiver.resolve(payload['id'], payload)
+        self.reply(200, {'status': 'ok'})
+
+    def parse_body(self, body):
+        body = body.decode('utf-8')
+        if 'application/x-www-form-urlencoded' in (self.headers.get('Content-Type') or ''):
+            form = dict((key, values[0]) for key, values in parse_qs(body).items())
+            return json.loads(form['data']) if 'data' in form else form
+        payload = json.loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError('The callback payload must be an object')
+        return payload
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CallbackReceiver(object):
+    # Receives the results posted to the callback_url and resolves the future of the job with the same process id.
+    # The callbacks can arrive before the job is registered with expect(), so those are kept until claimed.
+
+    def __init__(self, host='0.0.0.0', port=0, public_url=None, path='/megaoptim_callback', token=None):
+        self.host = host
+        self.port = port
+        self.public_url = public_url
+        self.path = path
+        self.token = token or uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.early = {}
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        # The url that is sent as the callback_url parameter. It has to be reachable by the MegaOptim servers,
+        # so public_url should be set when the receiver is behind a proxy or NAT.
+        if self.public_url is not None:
+            base = self.public_url.rstrip('/')
+        else:
+            base = 'http://' + self.server.server_address[0] + ':' + str(self.server.server_address[1])
+        return base + self.path + '?token=' + self.token
+
+    def start(self):
+        self.server = CallbackServer((self.host, self.port), CallbackHandler)
+        self.server.receiver = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def expect(self, process_id):
+        # Returns the future that is resolved with the payload of the callback of the job. concurrent.futures
+        # needs the futures backport on Python 2, so it is imported here like in the poller.
+        from concurrent.futures import Future
+        with self.lock:
+            if process_id in self.early:
+                future = Future()
+                future.set_result(self.early.pop(process_id))
+                return future
+            future = self.futures.get(process_id)
+            if future is None:
+                future = self.futures[process_id] = Future()
+            return future
+
+    def forget(self, process_id):
+        with self.lock:
+            self.futures.pop(process_id, None)
+            self.early.pop(process_id, None)
+
+    def resolve(self, process_id, payload):
+        with self.lock:
+            future = self.futures.pop(process_id, None)
+            if future is None:
+                self.early[process_id] = payload
+                return
+        if not future.done():
+            future.set_result(payload)
+
+    def optimize(self, client, resource, params):
+        # Sends the resource with the callback_url of this receiver and returns the future of its result.
+        params = dict(params)
+        params['callback_url'] = self.url
+        result = client.send(resource, params)
+        if result.get('status') != 'processing':
+            raise Exception(result.get('errors'))
+        return self.expect(result.get('process_id'))
@@ -1,20 +1,100 @@
 # coding=utf-8
 import requests
 import os.path
+import time
+
+from requests.adapters import HTTPAdapter
+
+from megaoptim.client.multipart import MultipartBody
+from megaoptim.client.poller import ResultPoller
+from megaoptim.client.retry import RateLimiter, RequestStats, RetryPolicy, DOWNLOAD, RESULT, UPLOAD
 
 from megaoptim import *
 
 
+def is_overloaded(status):
+    return status == 429 or status >= 500
+
+
 class Client(object):
 
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True,
+                 download_chunk_size=1048576, rate_limit=None, rate_burst=None, retry_policy=None,
+                 api_base_url='https://api.megaoptim.com/v1/', instrumentation=None, controller=None):
         if api_key is None:
             raise Exception('Please provide MegaOptim.com API key')
         self.api_key = api_key
-        self.api_base_url = 'https://api.megaoptim.com/v1/'
+        # The base url can point to a compatible server, e.g. the local mock server used by the benchmarks.
+        self.api_base_url = api_base_url.rstrip('/') + '/'
         self.api_optimize_url = self.api_base_url + 'optimize'
         self.api_user_agent = 'MegaOptim Python Client v1.0.0'
         self.api_headers = {'User-Agent': self.api_user_agent, 'X-API-KEY': self.api_key}
+        self.download_chunk_size = download_chunk_size
+        self.session = self.create_session(pool_connections, pool_maxsize, pool_block, keep_alive)
+        # The rate limiter applies to the API requests, the retry policy to every request of the client.
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst) if rate_limit else None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.stats = RequestStats()
+        # Receives the timing events of the uploads, result polls, downloads and retries when set.
+        self.instrumentation = instrumentation
+        # Adjusts the number of uploads and downloads in flight when set, see ConcurrencyController.
+        self.controller = controller
+
+    def create_session(self, pool_connections, pool_maxsize, pool_block, keep_alive):
+        # One session is shared by the uploads, the result polling and the downloads so the
+        # TCP+TLS connections are reused. pool_connections is the number of hosts to keep pools for,
+        # pool_maxsize is the number of connections kept per host and pool_block makes the callers
+        # wait for a free connection instead of opening extra ones above the limit.
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def emit(self, name, start, **fields):
+        if self.instrumentation is not None:
+            self.instrumentation.emit(name, start, **fields)
+
+    def request(self, kind, method, url, rewind=None, **kwargs):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None and kind != DOWNLOAD:
+                waited = self.rate_limiter.acquire()
+                if waited > 0:
+                    self.stats.increment('throttled')
+            self.stats.increment(kind + '_requests')
+            start = time.time()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except Exception as e:
+                if not self.retry_policy.should_retry(kind, attempt, error=e):
+                    raise
+                delay = self.retry_policy.get_delay(attempt)
+                self.emit('retry', start, kind=kind, attempt=attempt, delay=delay, error=type(e).__name__)
+            else:
+                if not self.retry_policy.should_retry(kind, attempt, status=r.status_code):
+                    return r
+                delay = self.retry_policy.get_delay(attempt, r.headers.get('Retry-After'))
+                self.emit('retry', start, kind=kind, attempt=attempt, delay=delay, status=r.status_code)
+                r.close()
+            self.stats.increment(kind + '_retries')
+            if self.controller is not None:
+                self.controller.retried(kind)
+            time.sleep(delay)
+            if rewind is not None:
+                rewind()
+            attempt += 1
 
     def get_result(self, job_id, timeout=300):
         if job_id is None:
@@ -22,7 +102,13 @@ class Client(object):
                                 '/optimize endpoint and your job has been queued for processing.')
         results_endpoint = self.api_optimize_url + '/' + job_id + '/result?timeout=' + str(timeout)
 
-        r = requests.post(url=results_endpoint, headers=self.api_headers)
+        start = time.time()
+        try:
+            r = self.request(RESULT, 'POST', results_endpoint, headers=self.api_headers)
+        except Exception as e:
+            self.emit('result', start, process_id=job_id, timeout=timeout, error=type(e).__name__)
+            raise
+        self.emit('result', start, process_id=job_id, timeout=timeout, status=r.status_code)
         if r.ok:
             return r.json()
         else:
@@ -32,59 +118,37 @@ class Client(object):
                 raise Exception('Failed to parse JSON response from MegaOptim.com API')
 
     def send(self, resource=None, params=None):
-        help = 'Invalid resouce type. Resource must be valid image. Also it should any of the following: image url, ' \
-               'local image path, tuple of up to 5 image urls or tuple of up to 5 local image paths. '
-        if resource is None:
-            raise Exception('Please provide a valid file path to the image')
-        if params is None:
-            raise Exception('Please provide image optimization parameters')
-        if not isinstance(params, dict):
-            raise Exception('The parameter \'params\' must be of typ dict')
-
-        params = maybe_set_default('compression', 'intelligent', params)
-        params = maybe_set_default('keep_exif', '1', params)
-        params = maybe_set_default('cmyktorgb', '1', params)
-        params = maybe_set_default('max_width', '0', params)
-        params = maybe_set_default('max_height', '0', params)
-
-        files = dict()
-        if isinstance(resource, tuple):
-            if len(resource) > 5 or len(resource) < 1:
-                raise Exception(help)
-            else:
-                valid_files = False
-                valid_urls = all(validate_url(item) for item in resource)
-                if not valid_urls:
-                    valid_files = all(os.path.isfile(item) for item in resource)
-                if valid_urls:
-                    for i, item in enumerate(resource):
-                        no = (i + 1)
-                        index = 'url' + str(no)
-                        params[index] = item
-                    params['type'] = 'urls'
-                elif valid_files:
-                    for i, item in enumerate(resource):
-                        no = (i + 1)
-                        index = 'file' + str(no)
-                        files[index] = get_file(item)
-                    params['type'] = 'files'
-                else:
-                    raise Exception(help)
-        else:
-            if validate_url(resource):
-                params['url'] = resource
-                params['type'] = 'url'
-            elif os.path.isfile(resource):
-                files['file'] = get_file(resource)
-                params['type'] = 'file'
-            else:
-                raise Exception(help)
+        _type, fields = classify_resource(resource)
+        params = prepare_params(params)
+        params['type'] = _type
 
-        requires_upload = params['type'] == 'file' or params['type'] == 'files'
-        if requires_upload:
-            r = requests.post(url=self.api_optimize_url, headers=self.api_headers, files=files, data=params)
-        else:
-            r = requests.post(url=self.api_optimize_url, headers=self.api_headers, data=params)
+        if self.controller is not None:
+            self.controller.acquire(UPLOAD)
+        start = time.time()
+        size = None
+        try:
+            if requires_upload(_type):
+                # The files are streamed from disk or from the buffers and closed even if the request fails.
+                body = MultipartBody(params, fields)
+                try:
+                    size = len(body)
+                    headers = dict(self.api_headers)
+                    headers['Content-Type'] = body.content_type
+                    r = self.request(UPLOAD, 'POST', self.api_optimize_url, rewind=body.rewind, headers=headers,
+                                     data=body)
+                finally:
+                    body.close()
+            else:
+                params.update(fields)
+                r = self.request(UPLOAD, 'POST', self.api_optimize_url, headers=self.api_headers, data=params)
+        except Exception as e:
+            self.emit('upload', start, files=len(fields), bytes=size, error=type(e).__name__)
+            if self.controller is not None:
+                self.controller.release(UPLOAD, time.time() - start, size, failed=True)
+            raise
+        self.emit('upload', start, files=len(fields), bytes=size, status=r.status_code)
+        if self.controller is not None:
+            self.controller.release(UPLOAD, time.time() - start, size, failed=is_overloaded(r.status_code))
 
         if r.ok:
             return r.json()
@@ -94,6 +158,44 @@ class Client(object):
             except Exception as e:
                 raise Exception('Failed to parse JSON response from MegaOptim.com API')
 
+    def download(self, url, save_path, expected_size=None):
+        # The file is downloaded into a temporary file next to the target and renamed over it only once it
+        # is complete, so a failed download never leaves a truncated image behind.
+        if os.path.isdir(save_path):
+            return False
+        fd, temp_path = create_temp_file(save_path)
+        if self.controller is not None:
+            self.controller.acquire(DOWNLOAD)
+        start = time.time()
+        written = 0
+        status = None
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with self.request(DOWNLOAD, 'GET', url, stream=True) as r:
+                    status = r.status_code
+                    if not r.ok:
+                        remove_temp_file(temp_path)
+                        self.emit('download', start, url=url, bytes=0, status=r.status_code, error='status')
+                        return False
+                    for chunk in r.iter_content(chunk_size=self.download_chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+            if expected_size is not None and written != int(expected_size):
+                remove_temp_file(temp_path)
+                self.emit('download', start, url=url, bytes=written, status=r.status_code, error='size')
+                return False
+            commit_temp_file(temp_path, save_path)
+        except Exception as e:
+            remove_temp_file(temp_path)
+            self.emit('download', start, url=url, bytes=written, error=type(e).__name__)
+            raise
+        finally:
+            if self.controller is not None:
+                self.controller.release(DOWNLOAD, time.time() - start, written,
+                                        failed=status is None or is_overloaded(status))
+        self.emit('download', start, url=url, bytes=written, status=r.status_code)
+        return os.path.exists(save_path)
+
     def optimize(self, resource, params, timeout=300):
         result = self.send(resource, params)
         if result.get('status') == 'processing':
@@ -104,3 +206,51 @@ class Client(object):
                 return self.get_result(process_id, timeout)
         else:
             raise Exception(result.get('errors'))
+
+    def optimize_many(self, resources, params, timeout=300, batch_size=5, window=10, receiver=None, journal=None,
+                      prepare=None, batcher=None):
+        # Streams any number of urls or local paths into multi-file requests of up to `batch_size` items and
+        # yields (source, result item) pairs as the batches finish. Up to `window` batches are pending at the
+        # same time and their results are polled together, so they are yielded in completion order. With a
+        # started CallbackReceiver the results are delivered to its callback_url instead of being polled.
+        # journal.record(process_id, batch, params) is called for every queued job before its result is awaited.
+        # prepare(batch) can return other resources to upload for a batch, e.g. resized copies of the images, the
+        # pairs are still yielded with the original sources. batcher(resources) can pack the resources into the
+        # batches instead of the fixed `batch_size` batches.
+        if receiver is not None:
+            params = dict(params)
+            params['callback_url'] = receiver.url
+        elif params is not None and params.get('callback_url') is not None:
+            raise Exception('The callback_url parameter is only supported together with a callback receiver')
+        with ResultPoller(self, timeout, receiver=receiver) as poller:
+            batches = batcher(resources) if batcher is not None else batch_resources(resources, batch_size)
+            for batch in batches:
+                # A batch that can not be sent, e.g. because a file was deleted or the retries were used up, is
+                # yielded with the error and the other batches go on.
+                try:
+                    upload = prepare(batch) if prepare is not None else batch
+                    response = self.send(upload if len(upload) > 1 else upload[0], params)
+                except Exception as e:
+                    response = {'status': 'error', 'errors': [str(e)]}
+                if response.get('status') == 'processing':
+                    if journal is not None:
+                        journal.record(response.get('process_id'), batch, params)
+                    poller.add(response.get('process_id'), batch)
+                else:
+                    for pair in self.batch_results(batch, response):
+                        yield pair
+                while poller.pending() >= window:
+                    for pair in self.batch_results(*poller.next_completed()):
+                        yield pair
+            for batch, response in poller.as_completed():
+                for pair in self.batch_results(batch, response):
+                    yield pair
+
+    def batch_results(self, batch, response):
+        # Pairs every source of the batch with its entry of the final response, or with the errors.
+        if response.get('status') == 'ok' and response.get('code') == 200:
+            pairs = map_results(batch, response.get('result') or [])
+        else:
+            pairs = [(source, None) for source in batch]
+        failed = {'success': 0, 'errors': response.get('errors') or [response.get('status')]}
+        return [(source, item if item is not None else failed) for source, item in pairs]
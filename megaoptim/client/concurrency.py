@@ -0,0 +1,127 @@
+import threading
+
+from megaoptim.client.retry import DOWNLOAD, UPLOAD
+
+# The latency baseline follows a higher latency slowly, so a lasting change of the images or the network becomes
+# the new normal while a sudden rise is seen as congestion.
+BASELINE_DRIFT = 0.05
+# Seconds a cost can exceed the tolerance before it is seen as congestion. The waits for the results are measured
+# with the polling interval, so they need a larger margin than the request latencies.
+SLACK = {'latency': 0.05, 'wait': 2.0}
+
+
+class AIMDLimit(object):
+    # Limits the number of requests of one kind in flight. The limit starts at `minimum` and doubles every round
+    # (slow start) until the first congestion, then grows by one per round of `limit` requests (additive increase)
+    # and is multiplied by `decrease` when a request fails, is retried or its cost rises clearly above `tolerance`
+    # times the baseline of its signal (multiplicative decrease), at most once per round so the requests that were
+    # already in flight do not decrease it again.
+
+    def __init__(self, name, minimum=1, maximum=16, decrease=0.5, tolerance=2.0, on_change=None):
+        if minimum < 1 or maximum < minimum:
+            raise Exception('The concurrency limits must be 1 <= minimum <= maximum')
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.on_change = on_change
+        self.limit = float(minimum)
+        self.in_flight = 0
+        self.peak = 0
+        self.slow_start = True
+        self.completed = 0
+        self.round_end = 0
+        self.baselines = {}
+        self.condition = threading.Condition()
+
+    def current(self):
+        return int(self.limit)
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, cost=None, failed=False, signal='latency'):
+        with self.condition:
+            self.in_flight -= 1
+            change = self.update(cost, failed, signal)
+            self.condition.notify_all()
+        if change is not None and self.on_change is not None:
+            self.on_change(self.name, *change)
+
+    def observe(self, cost=None, failed=False, signal='latency'):
+        # Takes a measurement that is not tied to a slot, e.g. a retry or the wait for a result.
+        with self.condition:
+            change = self.update(cost, failed, signal)
+            self.condition.notify_all()
+        if change is not None and self.on_change is not None:
+            self.on_change(self.name, *change)
+
+    def update(self, cost, failed, signal):
+        # Returns (old limit, new limit, reason) when the integer limit changed.
+        self.completed += 1
+        reason = 'error' if failed else None
+        if cost is not None:
+            baseline = self.baselines.get(signal)
+            if baseline is not None and cost > baseline * self.tolerance + SLACK.get(signal, 0) and reason is None:
+                reason = signal
+            if baseline is None or cost < baseline:
+                self.baselines[signal] = cost
+            else:
+                self.baselines[signal] = baseline + (cost - baseline) * BASELINE_DRIFT
+        old = int(self.limit)
+        if reason is not None:
+            if self.completed < self.round_end:
+                return None
+            self.slow_start = False
+            self.limit = max(float(self.minimum), self.limit * self.decrease)
+            self.round_end = self.completed + self.in_flight + 1
+        elif self.slow_start:
+            self.limit = min(float(self.maximum), self.limit + 1)
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+        if int(self.limit) == old:
+            return None
+        return old, int(self.limit), reason or 'increase'
+
+
+class ConcurrencyController(object):
+    # Adjusts the number of uploads and downloads in flight between `minimum` and `maximum` from what the client
+    # observes: the upload latency per megabyte, the time the jobs wait for their results, the download latency
+    # per megabyte, and the failed and retried requests. The threads wait in acquire() while the limit is reached,
+    # so it is meant for a client used by `maximum` threads, like the command line tool with --workers.
+
+    def __init__(self, minimum=1, maximum=16, decrease=0.5, tolerance=2.0, on_change=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limits = {
+            UPLOAD: AIMDLimit(UPLOAD, minimum, maximum, decrease, tolerance, on_change),
+            DOWNLOAD: AIMDLimit(DOWNLOAD, minimum, maximum, decrease, tolerance, on_change),
+        }
+
+    def acquire(self, kind):
+        self.limits[kind].acquire()
+
+    def release(self, kind, seconds, size=None, failed=False):
+        # The latency is divided by the megabytes transferred, so the large images are not seen as congestion.
+        cost = seconds / max(1.0, size / 1048576.0) if size else seconds
+        self.limits[kind].release(cost, failed)
+
+    def retried(self, kind):
+        if kind in self.limits:
+            self.limits[kind].observe(failed=True)
+
+    def waited(self, seconds, failed=False):
+        # A longer wait for the results means the jobs queue up on the server, so fewer uploads are sent.
+        self.limits[UPLOAD].observe(seconds, failed, signal='wait')
+
+    def snapshot(self):
+        gauges = {}
+        for kind, limit in self.limits.items():
+            gauges[kind + '_limit'] = limit.current()
+            gauges[kind + '_peak'] = limit.peak
+        return gauges
@@ -0,0 +1,148 @@
+# coding=utf-8
+import json
+import threading
+import time
+
+# Upper bounds in seconds of the duration histogram buckets, the last bucket is +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+           300.0)
+
+
+class Instrumentation(object):
+    # Dispatches the timing events of a client to its subscribers. An event is a dict with the `event` name, the
+    # start `time`, the `duration` in seconds and the fields of the event, e.g. {'event': 'upload', 'time': ...,
+    # 'duration': 0.2, 'files': 5, 'status': 200}. The clients emit upload, result, wait, download and retry
+    # events and the command line tool the scan, dedup, record and run stages. The clients and the command line
+    # tool only measure anything when an instrumentation is set.
+
+    def __init__(self, *subscribers):
+        self.subscribers = list(subscribers)
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def emit(self, name, start, **fields):
+        event = {'event': name, 'time': start, 'duration': time.time() - start}
+        event.update(fields)
+        for subscriber in self.subscribers:
+            subscriber(event)
+
+
+class JsonLinesTrace(object):
+    # Writes every event as a JSON line to the file.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def __call__(self, event):
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, event):
+        duration = event['duration']
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+        self.bytes += event.get('bytes') or 0
+        if event.get('error') is not None:
+            self.errors += 1
+        index = 0
+        while index < len(BUCKETS) and duration > BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+
+    def quantile(self, q):
+        # Estimated by interpolating inside the bucket that holds the quantile, like Prometheus does.
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class MetricsCollector(object):
+    # Aggregates the events into a duration histogram per event name, in constant memory.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def __call__(self, event):
+        with self.lock:
+            histogram = self.histograms.get(event['event'])
+            if histogram is None:
+                histogram = self.histograms[event['event']] = Histogram()
+            histogram.add(event)
+
+    def prometheus(self, counters=None, gauges=None):
+        # Returns the histograms, the given counters such as Client.stats.snapshot() and gauges such as
+        # ConcurrencyController.snapshot(), in the Prometheus text exposition format.
+        lines = ['# HELP megaoptim_event_duration_seconds Duration of the client requests and the stages.',
+                 '# TYPE megaoptim_event_duration_seconds histogram']
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                cumulative = 0
+                for index, bound in enumerate(BUCKETS + ('+Inf',)):
+                    cumulative += histogram.buckets[index]
+                    lines.append('megaoptim_event_duration_seconds_bucket{event="%s",le="%s"} %d' %
+                                 (name, bound, cumulative))
+                lines.append('megaoptim_event_duration_seconds_sum{event="%s"} %f' % (name, histogram.sum))
+                lines.append('megaoptim_event_duration_seconds_count{event="%s"} %d' % (name, histogram.count))
+            lines.append('# HELP megaoptim_event_errors_total Number of failed client requests and stages.')
+            lines.append('# TYPE megaoptim_event_errors_total counter')
+            for name in sorted(self.histograms):
+                lines.append('megaoptim_event_errors_total{event="%s"} %d' % (name, self.histograms[name].errors))
+            lines.append('# HELP megaoptim_event_bytes_total Number of bytes uploaded and downloaded.')
+            lines.append('# TYPE megaoptim_event_bytes_total counter')
+            for name in sorted(self.histograms):
+                if self.histograms[name].bytes:
+                    lines.append('megaoptim_event_bytes_total{event="%s"} %d' % (name, self.histograms[name].bytes))
+        if counters:
+            lines.append('# HELP megaoptim_client_total Number of requests, retries and throttled requests.')
+            lines.append('# TYPE megaoptim_client_total counter')
+            for name in sorted(counters):
+                lines.append('megaoptim_client_total{name="%s"} %d' % (name, counters[name]))
+        if gauges:
+            lines.append('# HELP megaoptim_client_gauge Current concurrency limits and peaks of the client.')
+            lines.append('# TYPE megaoptim_client_gauge gauge')
+            for name in sorted(gauges):
+                lines.append('megaoptim_client_gauge{name="%s"} %d' % (name, gauges[name]))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # Returns a line per event name with the count, the errors and the estimated duration quantiles.
+        lines = []
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                lines.append('%-9s count %6d  errors %4d  mean %8.1f ms  p50 %8.1f ms  p90 %8.1f ms  p99 %8.1f ms  '
+                             'max %8.1f ms' % (name, histogram.count, histogram.errors,
+                                               histogram.sum / histogram.count * 1000,
+                                               histogram.quantile(0.5) * 1000, histogram.quantile(0.9) * 1000,
+                                               histogram.quantile(0.99) * 1000, histogram.max * 1000))
+        return '\n'.join(lines)
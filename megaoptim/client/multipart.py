@@ -0,0 +1,190 @@
+# coding=utf-8
+import io
+import os
+import uuid
+
+from megaoptim import cStringIO, is_buffer, resource_name
+
+
+def byte_view(data):
+    # Returns a view of the buffer with one item per byte, which is sliced without copying the buffer. Python 2
+    # has no memoryview.cast, its buffers are sliced as they are and its memoryviews copied to bytes.
+    if not hasattr(memoryview, 'cast'):
+        return data.tobytes() if isinstance(data, memoryview) else data
+    view = memoryview(data)
+    return view.cast('B') if view.ndim != 1 or view.itemsize != 1 else view
+
+
+def quote_header_param(value):
+    # Percent-encodes the quotes and line breaks of a Content-Disposition parameter like urllib3 does, so a file
+    # name can neither end the parameter nor add header lines.
+    return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+class Source(object):
+    # A single file of the multipart body. Local paths are opened here and closed by close(), in-memory buffers
+    # are read through a memoryview so their content is never copied as a whole.
+
+    def __init__(self, resource):
+        self.file = None
+        self.view = None
+        self.owned = False
+        self.position = 0
+        if isinstance(resource, io.BytesIO):
+            # Python 2 has no BytesIO.getbuffer, its content is copied once.
+            self.view = byte_view(resource.getbuffer() if hasattr(resource, 'getbuffer') else resource.getvalue())
+        elif isinstance(resource, cStringIO):
+            self.view = byte_view(resource.getvalue())
+        elif is_buffer(resource):
+            self.view = byte_view(resource)
+        elif hasattr(resource, 'read'):
+            self.file = resource
+        else:
+            self.file = open(resource, 'rb')
+            self.owned = True
+        if self.view is not None:
+            self.length = len(self.view)
+        else:
+            self.start = self.file.tell()
+            try:
+                self.length = os.fstat(self.file.fileno()).st_size - self.start
+            except (AttributeError, OSError):
+                # A file-like object without a file descriptor is measured by seeking to its end.
+                self.file.seek(0, os.SEEK_END)
+                self.length = self.file.tell() - self.start
+                self.file.seek(self.start)
+
+    def read(self, size):
+        if self.view is not None:
+            chunk = self.view[self.position:self.position + size]
+            self.position += len(chunk)
+            return chunk
+        return self.file.read(size)
+
+    def rewind(self):
+        if self.view is not None:
+            self.position = 0
+        else:
+            self.file.seek(self.start)
+
+    def payload(self):
+        # The file is wrapped, so a library that closes what it sent leaves it open for a retry and its owner.
+        return self.view if self.view is not None else NonClosingFile(self.file)
+
+    def close(self):
+        if self.view is not None:
+            if isinstance(self.view, memoryview) and hasattr(self.view, 'release'):
+                self.view.release()
+            self.view = None
+        if self.owned and self.file is not None:
+            self.file.close()
+        self.file = None
+
+
+class NonClosingFile(io.RawIOBase):
+    # Reads, seeks and measures the wrapped file, but closing it only closes the wrapper. aiohttp closes the files
+    # of a form once it sent them.
+
+    def __init__(self, file):
+        self.file = file
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readinto(self, buffer):
+        chunk = self.file.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def fileno(self):
+        if not hasattr(self.file, 'fileno'):
+            raise io.UnsupportedOperation('fileno')
+        return self.file.fileno()
+
+
+class MultipartBody(object):
+    # Streams a multipart/form-data body. The parts are read one after another in chunks, so the files are never
+    # loaded into memory, and the total length is known upfront so the request is sent with a Content-Length.
+
+    def __init__(self, fields, files, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.sources = []
+        self.parts = []
+        try:
+            for name, value in fields.items():
+                self.parts.append(self.part_header(name) + str(value).encode('utf-8') + b'\r\n')
+            for name, resource in files.items():
+                source = Source(resource)
+                self.sources.append(source)
+                self.parts.append(self.part_header(name, self.get_filename(name, resource)))
+                self.parts.append(source)
+                self.parts.append(b'\r\n')
+            self.parts.append(b'--' + self.boundary.encode('ascii') + b'--\r\n')
+        except Exception:
+            self.close()
+            raise
+        self.length = sum(len(part) if isinstance(part, bytes) else part.length for part in self.parts)
+        self.index = 0
+        self.offset = 0
+
+    def part_header(self, name, filename=None):
+        disposition = 'form-data; name="' + quote_header_param(name) + '"'
+        if filename is not None:
+            disposition += '; filename="' + quote_header_param(filename) + '"'
+        header = '--' + self.boundary + '\r\nContent-Disposition: ' + disposition + '\r\n'
+        if filename is not None:
+            header += 'Content-Type: application/octet-stream\r\n'
+        return (header + '\r\n').encode('utf-8')
+
+    def get_filename(self, name, resource):
+        return resource_name(resource) or name
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        chunk = self.read(65536)
+        while chunk:
+            yield chunk
+            chunk = self.read(65536)
+
+    def read(self, size=-1):
+        # Returns the next chunk of at most `size` bytes, without joining the parts.
+        if size is None or size < 0:
+            size = self.length
+        while self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, bytes):
+                chunk = part[self.offset:self.offset + size]
+                self.offset += len(chunk)
+            else:
+                chunk = part.read(size)
+            if chunk:
+                return chunk
+            self.index += 1
+            self.offset = 0
+        return b''
+
+    def rewind(self):
+        # Allows the same body to be sent again when the upload is retried.
+        self.index = 0
+        self.offset = 0
+        for source in self.sources:
+            source.rewind()
+
+    def close(self):
+        for source in self.sources:
+            source.close()
@@ -0,0 +1,187 @@
+# coding=utf-8
+import heapq
+import itertools
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Job(object):
+    __slots__ = ('process_id', 'context', 'deadline', 'interval', 'notify', 'done', 'future', 'started', 'polls')
+
+    def __init__(self, process_id, context, deadline, interval, notify):
+        self.process_id = process_id
+        self.context = context
+        self.deadline = deadline
+        self.interval = interval
+        self.notify = notify
+        # concurrent.futures needs the futures backport on Python 2, so it is only imported once a job is polled.
+        from concurrent.futures import Future
+        self.done = False
+        self.future = Future()
+        self.started = time.time()
+        self.polls = 0
+
+
+class ResultPoller(object):
+    # Waits for the results of many jobs with a few connections. Every job is polled with a short server side
+    # timeout and polled again after an interval that grows with every unfinished poll, so thousands of pending
+    # jobs do not hold a thread and a connection each. When a single job is pending it is long-polled instead.
+    # With a callback receiver the jobs are resolved by their callbacks and polled only if the callback did not
+    # arrive within callback_timeout seconds.
+
+    def __init__(self, client, timeout=300, workers=2, min_interval=1.0, max_interval=20.0, backoff=1.5,
+                 poll_timeout=0, long_poll_timeout=30, receiver=None, callback_timeout=60):
+        self.client = client
+        self.receiver = receiver
+        self.callback_timeout = callback_timeout
+        self.timeout = timeout
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.poll_timeout = poll_timeout
+        self.long_poll_timeout = long_poll_timeout
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.completed = queue.Queue()
+        self.unclaimed = 0
+        self.closed = False
+        self.threads = []
+
+    def submit(self, process_id, context=None, timeout=None):
+        # Returns a future that is resolved with the final response of the job.
+        return self.schedule(process_id, context, timeout, False).future
+
+    def add(self, process_id, context=None, timeout=None):
+        # Adds the job to the ones returned by next_completed() and as_completed() in completion order.
+        return self.schedule(process_id, context, timeout, True).future
+
+    def schedule(self, process_id, context, timeout, notify):
+        if process_id is None:
+            raise Exception('Please provide valid MegaOptim process id. Process ID is returned after you call the '
+                            '/optimize endpoint and your job has been queued for processing.')
+        timeout = self.timeout if timeout is None else timeout
+        job = Job(process_id, context, time.time() + timeout, self.min_interval, notify)
+        first_poll = time.time()
+        if self.receiver is not None:
+            first_poll += min(self.callback_timeout, timeout)
+        with self.condition:
+            if self.closed:
+                raise Exception('The result poller is closed')
+            if notify:
+                self.unclaimed += 1
+            heapq.heappush(self.heap, (first_poll, next(self.counter), job))
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.condition.notify()
+        if self.receiver is not None:
+            self.receiver.expect(process_id).add_done_callback(lambda future: self.finish(job, future.result()))
+        return job
+
+    def pending(self):
+        with self.condition:
+            return self.unclaimed
+
+    def next_completed(self):
+        # Blocks until one of the added jobs is finished and returns its (context, response).
+        context, response = self.completed.get()
+        with self.condition:
+            self.unclaimed -= 1
+        return context, response
+
+    def as_completed(self):
+        while self.pending() > 0:
+            yield self.next_completed()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            jobs = [item[2] for item in self.heap]
+            self.heap = []
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        # The jobs that were still pending are resolved so nobody waits for them forever.
+        for job in jobs:
+            self.abandon(job)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def next_job(self):
+        with self.condition:
+            while not self.closed and (not self.heap or self.heap[0][0] > time.time()):
+                self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+            if self.closed:
+                return None, False
+            job = heapq.heappop(self.heap)[2]
+            return job, not self.heap
+
+    def abandon(self, job):
+        with self.condition:
+            if job.done:
+                return
+            job.done = True
+        self.client.emit('wait', job.started, process_id=job.process_id, polls=job.polls, error='closed')
+        job.future.set_exception(Exception('The result poller was closed before the job ' + job.process_id +
+                                           ' finished'))
+
+    def work(self):
+        while True:
+            job, alone = self.next_job()
+            if job is None:
+                return
+            if job.done:
+                continue
+            remaining = job.deadline - time.time()
+            server_timeout = self.poll_timeout
+            if alone:
+                server_timeout = max(self.poll_timeout, min(self.long_poll_timeout, int(remaining)))
+            # The connection errors are retried like unfinished jobs until the deadline of the job.
+            job.polls += 1
+            try:
+                response = self.client.get_result(job.process_id, server_timeout)
+                unfinished = response.get('status') == 'processing'
+            except Exception as e:
+                response = {'status': 'error', 'errors': [str(e)]}
+                unfinished = True
+            if unfinished and time.time() < job.deadline:
+                with self.condition:
+                    if not self.closed:
+                        heapq.heappush(self.heap, (time.time() + job.interval, next(self.counter), job))
+                        job.interval = min(self.max_interval, job.interval * self.backoff)
+                        self.condition.notify()
+                        continue
+                self.abandon(job)
+            else:
+                self.finish(job, response)
+
+    def finish(self, job, response):
+        # A job can be finished by its callback and by the polling at the same time, only the first one counts.
+        with self.condition:
+            if job.done:
+                return
+            job.done = True
+        if self.receiver is not None:
+            self.receiver.forget(job.process_id)
+        # The wait covers the processing on the server and the polling, from the submission to the result.
+        self.client.emit('wait', job.started, process_id=job.process_id, polls=job.polls,
+                         status=response.get('status'))
+        controller = getattr(self.client, 'controller', None)
+        if controller is not None:
+            controller.waited(time.time() - job.started)
+        job.future.set_result(response)
+        if job.notify:
+            self.completed.put((job.context, response))
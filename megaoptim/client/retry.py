@@ -0,0 +1,124 @@
+# coding=utf-8
+import random
+import sys
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    from requests.exceptions import ConnectTimeout, ConnectionError as RequestsConnectionError
+    from urllib3.exceptions import NewConnectionError
+except ImportError:
+    ConnectTimeout = RequestsConnectionError = NewConnectionError = None
+
+UPLOAD = 'upload'
+RESULT = 'result'
+DOWNLOAD = 'download'
+
+
+def parse_retry_after(value):
+    # The Retry-After header is either a number of seconds or a HTTP date.
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, mktime_tz(parsed) - time.time())
+
+
+def is_connect_error(error):
+    # Tells if the request failed before it reached the server, which makes it safe to send the upload again.
+    if ConnectTimeout is not None and isinstance(error, ConnectTimeout):
+        return True
+    if RequestsConnectionError is not None and isinstance(error, RequestsConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    # aiohttp is only checked if the async client already imported it.
+    aiohttp = sys.modules.get('aiohttp')
+    if aiohttp is not None and isinstance(error, aiohttp.ClientConnectorError):
+        return True
+    return False
+
+
+class RetryPolicy(object):
+    # Decides which failed requests are sent again and how long to wait before. The result polls and the downloads
+    # are idempotent and are retried on any connection error, 429 or 5xx response. An upload creates a new job on
+    # every request, so it is retried only if it never reached the server or the server refused it with 429 or 503.
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30.0, max_retry_after=120.0,
+                 retry_statuses=(429, 500, 502, 503, 504), upload_statuses=(429, 503)):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses
+        self.upload_statuses = upload_statuses
+
+    def should_retry(self, kind, attempt, status=None, error=None):
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            return kind != UPLOAD or is_connect_error(error)
+        if kind == UPLOAD:
+            return status in self.upload_statuses
+        return status in self.retry_statuses
+
+    def get_delay(self, attempt, retry_after=None):
+        # Exponential backoff with full jitter, or the Retry-After of the server if it asks for a longer wait.
+        delay = random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+class RateLimiter(object):
+    # Token bucket shared by all the threads and coroutines of a client. reserve() takes a token and returns how
+    # long the caller has to wait for it, so the same bucket can be used with time.sleep and asyncio.sleep.
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise Exception('The rate limit must be a positive number of requests per second')
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,316 @@
+# coding=utf-8
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, quote, unquote, urlparse
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote, unquote
+    from urllib2 import Request, urlopen
+    from urlparse import parse_qs, urlparse
+
+RESULT_PATH = re.compile(r'^/v1/optimize/([^/]+)/result$')
+DOWNLOAD_PATH = re.compile(r'^/downloads/([^/]+)/(\d+)/[^/]*$')
+
+
+def parse_multipart(body, content_type):
+    # Returns the (name, filename, content) of every part of a multipart/form-data body.
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise ValueError('Missing multipart boundary')
+    delimiter = b'--' + match.group(1).encode('ascii')
+    parts = []
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        head, _, content = part.partition(b'\r\n\r\n')
+        if content.endswith(b'\r\n'):
+            content = content[:-2]
+        disposition = head.decode('utf-8', 'replace')
+        name = re.search(r'\bname="([^"]*)"', disposition)
+        filename = re.search(r'\bfilename="([^"]*)"', disposition)
+        parts.append((name.group(1) if name else None, filename.group(1) if filename else None, content))
+    return parts
+
+
+class MockJob(object):
+
+    def __init__(self, process_id, ready_at, files, callback_url):
+        self.process_id = process_id
+        self.ready_at = ready_at
+        self.files = files
+        self.callback_url = callback_url
+        self.result = None
+
+
+class MockThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections alive like the real API, so the connection pooling can be measured.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.inject():
+            return
+        url = urlparse(self.path)
+        mock = self.server.mock
+        if mock.api_key is not None and self.headers.get('X-API-KEY') != mock.api_key:
+            return self.reply(401, {'status': 'error', 'code': 401, 'errors': ['Invalid API key']})
+        if url.path == '/v1/optimize':
+            return self.optimize(body)
+        match = RESULT_PATH.match(url.path)
+        if match is not None:
+            timeout = parse_qs(url.query).get('timeout', ['0'])[0]
+            return self.result(match.group(1), float(timeout))
+        self.reply(404, {'status': 'error', 'code': 404, 'errors': ['Not found']})
+
+    def do_GET(self):
+        if self.inject():
+            return
+        match = DOWNLOAD_PATH.match(urlparse(self.path).path)
+        content = None
+        if match is not None:
+            content = self.server.mock.get_content(match.group(1), int(match.group(2)))
+        if content is None:
+            return self.reply(404, {'status': 'error', 'code': 404, 'errors': ['Not found']})
+        self.server.mock.increment('downloads')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        # aiohttp sends the multipart bodies of unknown length with the chunked transfer encoding.
+        if 'chunked' in (self.headers.get('Transfer-Encoding') or '').lower():
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def inject(self):
+        # Adds the configured latency and fails the configured share of the requests with 503.
+        mock = self.server.mock
+        mock.increment('requests')
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+        if mock.error_rate > 0 and mock.random() < mock.error_rate:
+            mock.increment('errors')
+            self.reply(503, {'status': 'error', 'code': 503, 'errors': ['Service unavailable']},
+                       {'Retry-After': '0'})
+            return True
+        return False
+
+    def optimize(self, body):
+        content_type = self.headers.get('Content-Type') or ''
+        files = []
+        if content_type.startswith('multipart/form-data'):
+            fields = {}
+            for name, filename, content in parse_multipart(body, content_type):
+                if filename is not None:
+                    files.append((filename, content))
+                else:
+                    fields[name] = content.decode('utf-8')
+        else:
+            fields = dict((key, values[0]) for key, values in parse_qs(body.decode('utf-8')).items())
+            # The remote images are not fetched, they are replaced by generated content of url_size bytes.
+            for key in sorted(fields):
+                if re.match(r'^url\d?$', key):
+                    name = unquote(urlparse(fields[key]).path.rsplit('/', 1)[-1]) or key
+                    files.append((name, b'\0' * self.server.mock.url_size))
+        if not files:
+            return self.reply(400, {'status': 'error', 'code': 400, 'errors': ['No images were sent']})
+        if len(files) > 5:
+            return self.reply(400, {'status': 'error', 'code': 400, 'errors': ['Up to 5 images per request']})
+        job = self.server.mock.create_job(files, fields.get('callback_url'))
+        self.reply(200, {'status': 'processing', 'code': 202, 'process_id': job.process_id})
+
+    def result(self, process_id, timeout):
+        mock = self.server.mock
+        mock.increment('result_polls')
+        job = mock.get_job(process_id)
+        if job is None:
+            return self.reply(404, {'status': 'error', 'code': 404, 'errors': ['Invalid process id']})
+        # Like the real API the request waits up to `timeout` seconds for the job to finish.
+        remaining = job.ready_at - time.time()
+        if remaining > 0:
+            time.sleep(min(remaining, max(0.0, timeout)))
+        if time.time() < job.ready_at:
+            return self.reply(200, {'status': 'processing', 'code': 202, 'process_id': process_id})
+        self.reply(200, mock.get_result(job, self.base_url()))
+
+    def base_url(self):
+        return 'http://' + (self.headers.get('Host') or '%s:%d' % self.server.server_address)
+
+    def reply(self, code, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(object):
+    # Local stand-in for the MegaOptim API. It implements /v1/optimize, /v1/optimize/{id}/result and the downloads
+    # of the optimized files, which are the uploaded files truncated by saved_percent. Every request is delayed by
+    # `latency` seconds and failed with 503 at `error_rate`, every job finishes `processing_delay` seconds after it
+    # was created and is posted to its callback_url, if any.
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, processing_delay=0.0,
+                 saved_percent=40, url_size=102400, api_key=None, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.processing_delay = processing_delay
+        self.saved_percent = saved_percent
+        self.url_size = url_size
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.jobs = {}
+        self.counters = {}
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        # The api_base_url to create the clients with.
+        return 'http://%s:%d/v1/' % self.server.server_address
+
+    def start(self):
+        self.server = MockThreadingServer((self.host, self.port), MockHandler)
+        self.server.mock = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def increment(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def create_job(self, files, callback_url=None):
+        optimized = []
+        for name, content in files:
+            size = len(content) - len(content) * self.saved_percent // 100
+            optimized.append((name, len(content), content[:size]))
+        job = MockJob(str(uuid.uuid4()), time.time() + self.processing_delay, optimized, callback_url)
+        with self.lock:
+            self.jobs[job.process_id] = job
+            self.counters['jobs'] = self.counters.get('jobs', 0) + 1
+            self.counters['images'] = self.counters.get('images', 0) + len(files)
+        if callback_url:
+            timer = threading.Timer(self.processing_delay, self.post_callback, (job,))
+            timer.daemon = True
+            timer.start()
+        return job
+
+    def get_job(self, process_id):
+        with self.lock:
+            return self.jobs.get(process_id)
+
+    def get_content(self, process_id, index):
+        job = self.get_job(process_id)
+        if job is None or index >= len(job.files):
+            return None
+        return job.files[index][2]
+
+    def get_result(self, job, base_url):
+        result = []
+        for index, (name, original_size, content) in enumerate(job.files):
+            result.append({
+                'file_name': name,
+                'original_size': original_size,
+                'optimized_size': len(content),
+                'saved_bytes': original_size - len(content),
+                'saved_percent': self.saved_percent,
+                'url': base_url + '/downloads/' + job.process_id + '/' + str(index) + '/' + quote(name),
+                'success': 1
+            })
+        return {'status': 'ok', 'code': 200, 'result': result,
+                'user': {'name': 'Mock', 'email': 'mock@megaoptim.test', 'tokens': 0}}
+
+    def post_callback(self, job):
+        payload = self.get_result(job, 'http://%s:%d' % self.server.server_address)
+        payload['id'] = job.process_id
+        request = Request(job.callback_url, json.dumps(payload).encode('utf-8'),
+                          {'Content-Type': 'application/json'})
+        try:
+            urlopen(request, timeout=10).close()
+            self.increment('callbacks')
+        except Exception:
+            self.increment('callback_errors')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='megaoptim-mock', description='Local mock of the MegaOptim API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', default=8000, type=int, help='Port to listen on.')
+    parser.add_argument('--latency', default=0.0, type=float, help='Seconds added to every request.')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Share of the requests failed with 503.')
+    parser.add_argument('--processing-delay', default=0.0, type=float, help='Seconds every job takes to finish.')
+    parser.add_argument('--saved-percent', default=40, type=int, help='Percent saved on every image.')
+    parser.add_argument('--api-key', help='Accept only this API key. Any key is accepted by default.')
+    args = parser.parse_args()
+    mock = MockServer(args.host, args.port, args.latency, args.error_rate, args.processing_delay, args.saved_percent,
+                      api_key=args.api_key)
+    mock.start()
+    print('Mock MegaOptim API listening on ' + mock.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
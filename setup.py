@@ -24,9 +24,15 @@ setup(
     entry_points={'console_scripts': ['megaoptim = megaoptim.cli.cli:do']},
 
     install_requires=[
-        'requests'
+        'requests',
+        'futures; python_version < "3"'
     ],
 
+    extras_require={
+        'async': ['aiohttp'],
+        'images': ['Pillow']
+    },
+
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
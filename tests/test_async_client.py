@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+from megaoptim.client.async_client import AsyncClient
+from megaoptim.client.retry import RetryPolicy
+from megaoptim.mock.server import MockServer
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def test_upload_of_a_local_path_is_retried(tmp_path):
+    path = str(tmp_path / 'image.png')
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE + b'\0' * 1000)
+
+    async def optimize(url):
+        policy = RetryPolicy(max_retries=20, backoff_factor=0)
+        async with AsyncClient('test', api_base_url=url, retry_policy=policy) as client:
+            return await client.optimize((path, path), {}), client.stats.get('upload_retries')
+
+    with MockServer(error_rate=0.6, seed=1) as mock:
+        result, retries = asyncio.run(optimize(mock.url))
+        counters = mock.snapshot()
+    assert retries > 0
+    assert result['status'] == 'ok'
+    assert [item['original_size'] for item in result['result']] == [os.path.getsize(path)] * 2
+    assert counters['jobs'] == 1
+
+
+def test_upload_of_a_caller_file_is_retried_and_left_open(tmp_path):
+    path = str(tmp_path / 'image.png')
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE + b'\0' * 1000)
+
+    async def optimize(url, f):
+        policy = RetryPolicy(max_retries=20, backoff_factor=0)
+        async with AsyncClient('test', api_base_url=url, retry_policy=policy) as client:
+            return await client.optimize(f, {}), client.stats.get('upload_retries')
+
+    with MockServer(error_rate=0.7, seed=3) as mock:
+        with open(path, 'rb') as f:
+            result, retries = asyncio.run(optimize(mock.url, f))
+            assert not f.closed
+            counters = mock.snapshot()
+    assert retries > 0
+    assert result['status'] == 'ok'
+    assert result['result'][0]['original_size'] == os.path.getsize(path)
+    assert counters['jobs'] == 1
@@ -0,0 +1,311 @@
+import os
+import struct
+import sys
+
+import pytest
+
+from megaoptim.cli import cli
+from megaoptim.mock.server import MockServer
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+@pytest.fixture
+def mock():
+    with MockServer() as server:
+        yield server
+
+
+def write_image(path, index, size=1000):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE + struct.pack('>Q', index) + b'\0' * size)
+
+
+def run_cli(mock, *arguments):
+    argv = sys.argv
+    sys.argv = ['megaoptim', '--api-key', 'test', '--api-url', mock.url] + list(arguments)
+    try:
+        cli.do()
+    finally:
+        sys.argv = argv
+
+
+def test_subdirectory_skips_the_images_of_a_parent_run(mock, tmp_path):
+    root = str(tmp_path)
+    write_image(os.path.join(root, 'a.png'), 1)
+    write_image(os.path.join(root, 'sub', 'b.png'), 2)
+    run_cli(mock, '--dir', root, '--recursive', '1')
+    assert mock.snapshot()['images'] == 2
+    size = os.path.getsize(os.path.join(root, 'sub', 'b.png'))
+
+    run_cli(mock, '--dir', os.path.join(root, 'sub'))
+    assert mock.snapshot()['images'] == 2
+    assert os.path.getsize(os.path.join(root, 'sub', 'b.png')) == size
+    assert not os.path.exists(os.path.join(root, 'sub', '.megaoptim.db'))
+
+
+def test_parent_imports_the_manifest_of_a_subdirectory(mock, tmp_path):
+    root = str(tmp_path)
+    write_image(os.path.join(root, 'a.png'), 1)
+    write_image(os.path.join(root, 'sub', 'b.png'), 2)
+    run_cli(mock, '--dir', os.path.join(root, 'sub'))
+    assert mock.snapshot()['images'] == 1
+
+    run_cli(mock, '--dir', root, '--recursive', '1')
+    assert mock.snapshot()['images'] == 2
+    run_cli(mock, '--dir', os.path.join(root, 'sub'))
+    assert mock.snapshot()['images'] == 2
+
+
+def journal_job(mock, root, paths, owner):
+    # Sends the images and records the job in the manifest as if a run was interrupted while waiting for it.
+    from megaoptim.cli.journal import Journal
+    from megaoptim.cli.manifest import Manifest, find_manifest
+    from megaoptim.client.client import Client
+    with Client('test', api_base_url=mock.url) as client:
+        response = client.send(tuple(paths) if len(paths) > 1 else paths[0], {})
+    with Manifest(find_manifest(root)) as manifest:
+        journal = Journal(manifest)
+        journal.owner = owner
+        journal.record(response['process_id'], paths, {})
+    return response['process_id']
+
+
+def unfinished_jobs(root):
+    from megaoptim.cli.journal import Journal
+    from megaoptim.cli.manifest import Manifest, find_manifest
+    with Manifest(find_manifest(root)) as manifest:
+        return [job[0] for job in Journal(manifest).unfinished(86400)]
+
+
+def shard_paths(root, count):
+    # Returns an image path of every shard.
+    from megaoptim.cli.coordination import shard_of
+    paths = {}
+    index = 0
+    while len(paths) < count:
+        path = os.path.join(root, 'f%d.png' % index)
+        paths.setdefault(shard_of(path, root, count), path)
+        index += 1
+    return [paths[shard] for shard in range(count)]
+
+
+def test_resume_leaves_the_jobs_of_other_shards(mock, tmp_path):
+    root = str(tmp_path)
+    first, second = shard_paths(root, 2)
+    write_image(first, 1)
+    write_image(second, 2)
+    process_id = journal_job(mock, root, [first], None)
+
+    run_cli(mock, '--dir', root, '--shard', '1/2')
+    assert unfinished_jobs(root) == [process_id]
+    assert os.path.getsize(first) == 1016
+    assert mock.snapshot()['images'] == 2
+
+    run_cli(mock, '--dir', root, '--shard', '0/2')
+    assert unfinished_jobs(root) == []
+    assert os.path.getsize(first) < 1016
+    assert mock.snapshot()['images'] == 2
+
+
+def test_resume_leaves_the_jobs_of_running_processes(mock, tmp_path):
+    import socket
+    root = str(tmp_path)
+    path = os.path.join(root, 'a.png')
+    write_image(path, 1)
+    process_id = journal_job(mock, root, [path], socket.gethostname() + ':' + str(os.getppid()))
+
+    run_cli(mock, '--dir', root)
+    assert unfinished_jobs(root) == [process_id]
+    assert mock.snapshot()['images'] == 2
+
+
+def test_failed_copy_of_an_identical_image_is_skipped(mock, tmp_path):
+    root = str(tmp_path / 'images')
+    outdir = str(tmp_path / 'optimized')
+    write_image(os.path.join(root, 'a.png'), 1)
+    write_image(os.path.join(root, 'b.png'), 1)
+    write_image(os.path.join(root, 'c.png'), 2)
+    # The first identical image found is sent, the copy to the other one can not replace a directory.
+    sent, copy = [name for name in os.listdir(root) if name != 'c.png']
+    os.makedirs(os.path.join(outdir, copy))
+
+    run_cli(mock, '--dir', root, '--outdir', outdir, '--batch-size', '1')
+    assert mock.snapshot()['images'] == 2
+    assert os.path.isfile(os.path.join(outdir, sent))
+    assert os.path.isfile(os.path.join(outdir, 'c.png'))
+    assert os.path.isdir(os.path.join(outdir, copy))
+    assert [name for name in os.listdir(outdir) if name.endswith('.part')] == []
+
+
+def write_list(path, lines):
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def test_input_shards_split_the_urls(mock, tmp_path):
+    outdir = str(tmp_path / 'optimized')
+    os.makedirs(outdir)
+    urls = ['http://images.example/%d.png' % index for index in range(20)]
+    listing = str(tmp_path / 'urls.txt')
+    write_list(listing, urls)
+
+    run_cli(mock, '--input', listing, '--outdir', outdir, '--shard', '0/2', '--manifest', str(tmp_path / 'a.db'))
+    first = mock.snapshot()['images']
+    run_cli(mock, '--input', listing, '--outdir', outdir, '--shard', '1/2', '--manifest', str(tmp_path / 'b.db'))
+    assert 0 < first < 20
+    assert mock.snapshot()['images'] == 20
+
+
+def test_input_sends_the_failed_urls_again(mock, tmp_path):
+    outdir = str(tmp_path / 'optimized')
+    os.makedirs(outdir)
+    listing = str(tmp_path / 'urls.txt')
+    write_list(listing, ['http://images.example/a.png', 'http://images.example/b.png'])
+    # The file is in the way of the directory of the optimized images of the host.
+    with open(os.path.join(outdir, 'images.example'), 'w') as f:
+        f.write('')
+
+    run_cli(mock, '--input', listing, '--outdir', outdir, '--batch-size', '1')
+    assert mock.snapshot()['images'] == 2
+    os.remove(os.path.join(outdir, 'images.example'))
+    run_cli(mock, '--input', listing, '--outdir', outdir, '--batch-size', '1')
+    assert mock.snapshot()['images'] == 4
+    assert os.path.isfile(os.path.join(outdir, 'images.example', 'b.png'))
+    run_cli(mock, '--input', listing, '--outdir', outdir, '--batch-size', '1')
+    assert mock.snapshot()['images'] == 4
+
+
+def test_workers_optimize_every_image_once(mock, tmp_path):
+    root = str(tmp_path)
+    for index in range(23):
+        write_image(os.path.join(root, 'i%02d.png' % index), index)
+
+    run_cli(mock, '--dir', root, '--workers', '4', '--max-pending', '3')
+    counters = mock.snapshot()
+    assert counters['images'] == 23
+    assert counters['downloads'] == 23
+    assert all(os.path.getsize(os.path.join(root, 'i%02d.png' % index)) < 1016 for index in range(23))
+
+    run_cli(mock, '--dir', root, '--workers', '4')
+    assert mock.snapshot()['images'] == 23
+
+
+def test_dedup_sends_identical_images_once(mock, tmp_path):
+    root = str(tmp_path)
+    for name in ('a.png', 'b.png', 'c.png'):
+        write_image(os.path.join(root, name), 1)
+    write_image(os.path.join(root, 'd.png'), 2)
+
+    run_cli(mock, '--dir', root)
+    assert mock.snapshot()['images'] == 2
+    with open(os.path.join(root, 'a.png'), 'rb') as f:
+        optimized = f.read()
+    assert len(optimized) < 1016
+    for name in ('b.png', 'c.png'):
+        with open(os.path.join(root, name), 'rb') as f:
+            assert f.read() == optimized
+
+    # A copy added later is filled from the manifest without being sent.
+    write_image(os.path.join(root, 'e.png'), 1)
+    run_cli(mock, '--dir', root)
+    assert mock.snapshot()['images'] == 2
+    with open(os.path.join(root, 'e.png'), 'rb') as f:
+        assert f.read() == optimized
+
+
+def test_dedup_disabled_sends_every_image(mock, tmp_path):
+    root = str(tmp_path)
+    for name in ('a.png', 'b.png'):
+        write_image(os.path.join(root, name), 1)
+    run_cli(mock, '--dir', root, '--dedup', '0')
+    assert mock.snapshot()['images'] == 2
+
+
+def test_incremental_rescan_skips_unchanged_files(mock, tmp_path):
+    root = str(tmp_path)
+    for index in range(3):
+        write_image(os.path.join(root, 'i%d.png' % index), index)
+    run_cli(mock, '--dir', root)
+    assert mock.snapshot()['images'] == 3
+
+    run_cli(mock, '--dir', root)
+    assert mock.snapshot()['images'] == 3
+
+    # A file replaced after it was optimized is sent again, and only that one.
+    path = os.path.join(root, 'i1.png')
+    write_image(path, 10, size=2000)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    run_cli(mock, '--dir', root)
+    assert mock.snapshot()['images'] == 4
+    assert os.path.getsize(path) < 2016
+
+
+def test_non_incremental_rescan_skips_every_recorded_file(mock, tmp_path):
+    root = str(tmp_path)
+    path = os.path.join(root, 'a.png')
+    write_image(path, 1)
+    run_cli(mock, '--dir', root)
+
+    write_image(path, 10, size=2000)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    run_cli(mock, '--dir', root, '--incremental', '0')
+    assert mock.snapshot()['images'] == 1
+    assert os.path.getsize(path) == 2016
+
+
+def test_shards_optimize_every_image_once(mock, tmp_path):
+    root = str(tmp_path)
+    for index in range(20):
+        write_image(os.path.join(root, 'sub%d' % (index % 2), 'i%02d.png' % index), index)
+
+    run_cli(mock, '--dir', root, '--recursive', '1', '--shard', '0/2')
+    first = mock.snapshot()['images']
+    run_cli(mock, '--dir', root, '--recursive', '1', '--shard', '1/2')
+    assert 0 < first < 20
+    assert mock.snapshot()['images'] == 20
+    run_cli(mock, '--dir', root, '--recursive', '1')
+    assert mock.snapshot()['images'] == 20
+
+
+def test_leases_split_a_directory_between_processes(mock, tmp_path):
+    import subprocess
+    root = str(tmp_path)
+    for index in range(40):
+        write_image(os.path.join(root, 'i%02d.png' % index), index)
+    command = [sys.executable, '-c', 'from megaoptim.cli import cli; cli.do()', '--api-key', 'test',
+               '--api-url', mock.url, '--dir', root, '--leases', '1', '--batch-size', '2']
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([package, os.environ.get('PYTHONPATH', '')]))
+    processes = [subprocess.Popen(command, env=environment, stdout=subprocess.PIPE) for _ in range(3)]
+    assert [process.wait() for process in processes] == [0, 0, 0]
+    for process in processes:
+        process.stdout.close()
+    assert mock.snapshot()['images'] == 40
+    assert all(os.path.getsize(os.path.join(root, 'i%02d.png' % index)) < 1016 for index in range(40))
+
+
+def test_input_optimizes_urls_and_local_paths(mock, tmp_path):
+    import json
+    outdir = str(tmp_path / 'optimized')
+    os.makedirs(outdir)
+    local = str(tmp_path / 'images' / 'a.png')
+    write_image(local, 1)
+    listing = str(tmp_path / 'list.txt')
+    write_list(listing, ['http://images.example/x/1.png', '# comment',
+                         json.dumps({'url': 'http://images.example/2.png'}), json.dumps({'path': local}), '{broken'])
+
+    run_cli(mock, '--input', listing, '--outdir', outdir)
+    assert mock.snapshot()['images'] == 3
+    assert os.path.isfile(os.path.join(outdir, 'images.example', 'x', '1.png'))
+    assert os.path.isfile(os.path.join(outdir, 'images.example', '2.png'))
+    assert os.path.getsize(os.path.join(outdir, os.path.realpath(local).lstrip(os.sep))) < 1016
+    assert os.path.getsize(local) == 1016
+
+    # The checkpoint is past the end of the list, so nothing is read again.
+    run_cli(mock, '--input', listing, '--outdir', outdir)
+    assert mock.snapshot()['images'] == 3
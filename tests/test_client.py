@@ -0,0 +1,22 @@
+from megaoptim.client.client import Client
+from megaoptim.mock.server import MockServer
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def test_optimize_many_drops_only_the_failed_batch(tmp_path):
+    paths = []
+    for index in range(4):
+        path = str(tmp_path / ('image%d.png' % index))
+        with open(path, 'wb') as f:
+            f.write(PNG_SIGNATURE + b'\0' * 100)
+        paths.append(path)
+    missing = str(tmp_path / 'missing.png')
+
+    with MockServer() as mock:
+        with Client('test', api_base_url=mock.url) as client:
+            results = dict(client.optimize_many(paths[:2] + [missing] + paths[2:], {}, batch_size=2))
+    assert sorted(results) == sorted(paths + [missing])
+    assert results[missing]['success'] == 0 and results[missing]['errors']
+    assert results[paths[2]]['success'] == 0
+    assert all(results[path]['success'] == 1 for path in paths[:2] + paths[3:])
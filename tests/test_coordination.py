@@ -0,0 +1,80 @@
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+
+from megaoptim.cli.coordination import Leases
+from megaoptim.cli.journal import Journal
+from megaoptim.cli.manifest import COLUMNS, Manifest
+
+
+def expire(manifest, path):
+    with manifest.connection:
+        manifest.connection.execute('UPDATE leases SET expires = ? WHERE path = ?', (time.time() - 1, path))
+
+
+def test_batches_renew_the_claims(tmp_path):
+    with Manifest(str(tmp_path / 'manifest.db'), shared=True) as manifest:
+        first = Leases(manifest, owner='first')
+        second = Leases(manifest, owner='second')
+        assert first.claim('a.png') and first.claim('b.png')
+        expire(manifest, 'a.png')
+        expire(manifest, 'b.png')
+        assert second.claim('a.png')
+
+        assert list(first.batches([('a.png', 'b.png')])) == [('b.png',)]
+        assert first.busy_count == 1
+        assert not second.claim('b.png')
+        expires = manifest.connection.execute('SELECT expires FROM leases WHERE path = ?', ('b.png',)).fetchone()
+        assert expires[0] > time.time() + first.ttl - 60
+
+
+def test_batches_drop_the_files_finished_by_others(tmp_path):
+    with Manifest(str(tmp_path / 'manifest.db'), shared=True) as manifest:
+        leases = Leases(manifest, owner='first')
+        assert leases.claim('a.png')
+        batches = leases.batches([('a.png',)], recheck=lambda path: True)
+        assert list(batches) == []
+        assert manifest.connection.execute('SELECT COUNT(*) FROM leases').fetchone()[0] == 0
+
+
+def open_manifest(path, shared, barrier, errors):
+    barrier.wait()
+    try:
+        with Manifest(path, shared) as manifest:
+            Leases(manifest)
+            Journal(manifest)
+    except Exception as e:
+        errors.put(repr(e))
+
+
+@pytest.mark.parametrize('shared', [True, False])
+def test_processes_open_a_new_manifest_at_once(tmp_path, shared):
+    for trial in range(5):
+        path = str(tmp_path / ('manifest%d.db' % trial))
+        barrier = multiprocessing.Barrier(4)
+        errors = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=open_manifest, args=(path, shared, barrier, errors))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert errors.empty()
+        assert all(process.exitcode == 0 for process in processes)
+
+
+def test_manifest_upgrades_an_old_schema(tmp_path):
+    path = str(tmp_path / 'manifest.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, '
+                       'optimized_path TEXT, original_size INTEGER, optimized_size INTEGER, saved_bytes INTEGER, '
+                       'saved_percent INTEGER, url TEXT, date TEXT)')
+    connection.execute("INSERT INTO files (path, size) VALUES ('a.png', 10)")
+    connection.commit()
+    connection.close()
+    with Manifest(path) as manifest:
+        columns = [row[1] for row in manifest.connection.execute('PRAGMA table_info(files)')]
+        assert columns == COLUMNS
+        assert manifest.contains('a.png')
@@ -0,0 +1,28 @@
+import os
+
+from megaoptim import UMASK, commit_temp_file, create_temp_file
+
+
+def test_commit_gives_new_files_the_default_mode(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, 'umask', lambda mask: calls.append(mask) or 0)
+    save_path = str(tmp_path / 'image.png')
+    fd, temp_path = create_temp_file(save_path)
+    os.close(fd)
+    commit_temp_file(temp_path, save_path)
+    assert calls == []
+    assert os.stat(save_path).st_mode & 0o777 == 0o666 & ~UMASK
+
+
+def test_commit_keeps_the_mode_of_the_replaced_file(tmp_path):
+    save_path = str(tmp_path / 'image.png')
+    with open(save_path, 'wb') as f:
+        f.write(b'old')
+    os.chmod(save_path, 0o640)
+    fd, temp_path = create_temp_file(save_path)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'new')
+    commit_temp_file(temp_path, save_path)
+    assert os.stat(save_path).st_mode & 0o777 == 0o640
+    with open(save_path, 'rb') as f:
+        assert f.read() == b'new'
@@ -0,0 +1,54 @@
+import io
+import os
+
+from megaoptim.cli.inputs import Checkpoint, InputReader, input_save_path
+from megaoptim.cli.manifest import Manifest
+
+
+def test_reader_parses_every_line_format():
+    lines = [b'http://a.example/1.png\n', b'\n', b'# comment\n', b'{"url": "http://a.example/2.png"}\n',
+             b'"/images/3.png"\n', b'{"path": "/images/4.png"}\n', b'{"size": 1}\n', b'{broken\n', b'\xff\n',
+             b'/images/5.png']
+    reader = InputReader(io.BytesIO(b''.join(lines)))
+    entries = list(reader)
+    assert [entry[2] for entry in entries] == ['http://a.example/1.png', 'http://a.example/2.png', '/images/3.png',
+                                               '/images/4.png', '/images/5.png']
+    assert entries[0][:2] == (0, len(lines[0]))
+    assert entries[-1][1] == len(b''.join(lines))
+    assert reader.invalid_count == 3
+
+
+def test_reader_resumes_from_an_offset():
+    data = b'http://a.example/1.png\nhttp://a.example/2.png\n'
+    stream = io.BytesIO(data)
+    stream.seek(23)
+    assert [entry[2] for entry in InputReader(stream, 23)] == ['http://a.example/2.png']
+
+
+def test_checkpoint_moves_past_the_finished_prefix_only(tmp_path):
+    with Manifest(str(tmp_path / 'manifest.db')) as manifest:
+        checkpoint = Checkpoint(manifest, 'list', interval=0)
+        for index, resource in enumerate(['a', 'b', 'c']):
+            checkpoint.started(resource, index * 10, index * 10 + 10)
+        checkpoint.finished('b')
+        assert checkpoint.position == 0
+        checkpoint.finished('a')
+        assert checkpoint.position == 20
+        checkpoint.finished('c')
+        checkpoint.advance(40)
+        checkpoint.save()
+
+        checkpoint = Checkpoint(manifest, 'list')
+        assert checkpoint.load() == 40
+        assert checkpoint.load(size=30) == 0
+
+
+def test_save_paths_of_urls_and_local_paths(tmp_path):
+    outdir = str(tmp_path)
+    assert input_save_path('http://a.example:8080/x/y%20z.png', outdir) == \
+        os.path.join(outdir, 'a.example_8080', 'x', 'y z.png')
+    first = input_save_path('http://a.example/x.png?w=1', outdir)
+    second = input_save_path('http://a.example/x.png?w=2', outdir)
+    assert first != second and first.endswith('.png')
+    assert input_save_path('http://a.example/', outdir) == os.path.join(outdir, 'a.example', 'index')
+    assert input_save_path('/images/thumbs/../x.png', outdir) == os.path.join(outdir, 'images', 'x.png')
@@ -0,0 +1,79 @@
+import io
+import mmap
+
+from megaoptim.client.multipart import MultipartBody, Source
+
+
+class Reader(object):
+    # A file-like object without a file descriptor.
+
+    def __init__(self, content):
+        self.content = content
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.content) if size is None or size < 0 else self.position + size
+        chunk = self.content[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        self.position = [offset, self.position + offset, len(self.content) + offset][whence]
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+def test_source_measures_a_file_without_descriptor():
+    reader = Reader(b'0123456789')
+    reader.read(2)
+    source = Source(reader)
+    assert source.length == 8
+    assert source.read(100) == b'23456789'
+    source.rewind()
+    assert source.read(3) == b'234'
+
+
+def test_body_length_matches_its_content():
+    body = MultipartBody({'type': 'file'}, {'file': Reader(b'\x89PNG\r\n\x1a\n' + b'\0' * 100000)})
+    try:
+        content = b''.join(bytes(chunk) for chunk in body)
+        assert len(content) == len(body)
+        body.rewind()
+        assert b''.join(bytes(chunk) for chunk in body) == content
+    finally:
+        body.close()
+
+
+def test_file_name_can_not_add_header_lines():
+    image = io.BytesIO(b'\x89PNG\r\n\x1a\n')
+    image.name = 'my "best"\r\nX-Evil: 1.png'
+    body = MultipartBody({}, {'file': image}, boundary='boundary')
+    try:
+        content = b''.join(bytes(chunk) for chunk in body)
+    finally:
+        body.close()
+    headers = content.split(b'\r\n\r\n')[0].split(b'\r\n')
+    assert headers == [b'--boundary', b'Content-Disposition: form-data; name="file"; '
+                                      b'filename="my %22best%22%0D%0AX-Evil: 1.png"',
+                       b'Content-Type: application/octet-stream']
+
+
+def test_sources_of_every_buffer_type(tmp_path):
+    path = str(tmp_path / 'image.png')
+    with open(path, 'wb') as f:
+        f.write(b'0123456789')
+    with open(path, 'r+b') as f:
+        mapped = mmap.mmap(f.fileno(), 0)
+        try:
+            for resource in (b'0123456789', bytearray(b'0123456789'), memoryview(b'0123456789'),
+                             io.BytesIO(b'0123456789'), mapped, path):
+                source = Source(resource)
+                try:
+                    assert source.length == 10
+                    assert bytes(source.read(4)) == b'0123'
+                finally:
+                    source.close()
+        finally:
+            mapped.close()
@@ -0,0 +1,39 @@
+import threading
+import time
+
+from megaoptim.cli.pipeline import Pipeline
+
+
+def double(item):
+    yield item * 2
+
+
+def test_pipeline_yields_every_result():
+    pipeline = Pipeline(queue_size=2).add_stage(double, 3).add_stage(double, 2)
+    assert sorted(pipeline.run(range(100))) == [item * 4 for item in range(100)]
+
+
+def test_stopped_pipeline_leaves_no_thread_behind():
+    before = threading.active_count()
+    closed = []
+
+    def items():
+        try:
+            for item in range(100000):
+                yield item
+        finally:
+            closed.append(True)
+
+    pipeline = Pipeline(queue_size=2).add_stage(double, 4).add_stage(double, 4)
+    results = pipeline.run(items())
+    try:
+        for result in results:
+            raise ValueError(result)
+    except ValueError:
+        pass
+    results.close()
+    deadline = time.time() + 5
+    while threading.active_count() > before and time.time() < deadline:
+        time.sleep(0.05)
+    assert threading.active_count() == before
+    assert closed == [True]
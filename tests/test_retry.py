@@ -0,0 +1,53 @@
+import time
+from email.utils import formatdate
+
+from megaoptim.client.client import Client
+from megaoptim.client.retry import DOWNLOAD, RESULT, UPLOAD, RateLimiter, RetryPolicy, parse_retry_after
+from megaoptim.mock.server import MockServer
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def test_uploads_are_retried_only_when_refused():
+    policy = RetryPolicy(max_retries=3)
+    assert policy.should_retry(UPLOAD, 0, status=503)
+    assert policy.should_retry(UPLOAD, 0, status=429)
+    assert not policy.should_retry(UPLOAD, 0, status=500)
+    assert not policy.should_retry(UPLOAD, 0, error=ValueError('reset'))
+    assert policy.should_retry(RESULT, 0, status=502)
+    assert policy.should_retry(DOWNLOAD, 0, error=ValueError('reset'))
+    assert not policy.should_retry(RESULT, 3, status=502)
+
+
+def test_retry_after_sets_the_minimum_delay():
+    assert parse_retry_after('7') == 7.0
+    assert parse_retry_after('garbage') is None
+    assert 50 < parse_retry_after(formatdate(time.time() + 60, usegmt=True)) <= 60
+    policy = RetryPolicy(backoff_factor=0, max_retry_after=10)
+    assert policy.get_delay(0, '5') == 5
+    assert policy.get_delay(0, '500') == 10
+
+
+def test_rate_limiter_spaces_the_requests_after_the_burst():
+    limiter = RateLimiter(10, burst=2)
+    delays = [limiter.reserve() for _ in range(4)]
+    assert delays[:2] == [0.0, 0.0]
+    assert 0.05 < delays[2] <= 0.1
+    assert 0.15 < delays[3] <= 0.2
+
+
+def test_refused_uploads_create_a_single_job(tmp_path):
+    path = str(tmp_path / 'image.png')
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE + b'\0' * 1000)
+
+    with MockServer(error_rate=0.6, seed=1) as mock:
+        with Client('test', api_base_url=mock.url, retry_policy=RetryPolicy(max_retries=20, backoff_factor=0),
+                    rate_limit=50) as client:
+            result = client.optimize((path, path), {})
+            stats = client.stats.snapshot()
+        counters = mock.snapshot()
+    assert result['status'] == 'ok'
+    assert stats['upload_retries'] > 0
+    assert counters['jobs'] == 1
+    assert counters['errors'] == sum(stats.get(kind + '_retries', 0) for kind in (UPLOAD, RESULT, DOWNLOAD))
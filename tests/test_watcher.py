@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+from megaoptim.cli.watcher import Debouncer, InotifyWatcher, PollingWatcher
+
+
+def write(path, data=b'data'):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_until(watcher, expected, timeout=5.0):
+    changed = set()
+    deadline = time.time() + timeout
+    while not expected <= changed and time.time() < deadline:
+        changed.update(watcher.read(0.1))
+    return changed
+
+
+def test_debouncer_waits_until_the_file_is_settled(tmp_path):
+    path = os.path.join(str(tmp_path), 'a.png')
+    write(path)
+    debouncer = Debouncer(settle=2.0)
+    debouncer.add(path, 0)
+    assert debouncer.ready(0) == []
+    assert debouncer.ready(1) == []
+
+    # A file still being written starts its wait again.
+    write(path, b'more data')
+    assert debouncer.ready(1.5) == []
+    assert debouncer.ready(3) == []
+    assert debouncer.ready(3.5) == [path]
+    assert debouncer.count() == 0
+
+
+def test_debouncer_drops_removed_files(tmp_path):
+    path = os.path.join(str(tmp_path), 'a.png')
+    write(path)
+    debouncer = Debouncer(settle=0)
+    debouncer.add(path, 0)
+    os.remove(path)
+    assert debouncer.ready(1) == []
+    assert debouncer.count() == 0
+
+
+def test_polling_watcher_returns_new_and_modified_files(tmp_path):
+    root = str(tmp_path)
+    os.mkdir(os.path.join(root, 'excluded'))
+    write(os.path.join(root, 'old.png'))
+    write(os.path.join(root, 'same.png'))
+    watcher = PollingWatcher(root, exclude=set([os.path.join(root, 'excluded')]), interval=0.1)
+    try:
+        os.mkdir(os.path.join(root, 'sub'))
+        write(os.path.join(root, 'sub', 'new.png'))
+        write(os.path.join(root, 'old.png'), b'modified')
+        write(os.path.join(root, 'excluded', 'skipped.png'))
+        expected = set([os.path.join(root, 'sub', 'new.png'), os.path.join(root, 'old.png')])
+        assert read_until(watcher, expected) == expected
+    finally:
+        watcher.close()
+
+
+def test_inotify_watcher_returns_the_files_of_new_directories(tmp_path):
+    root = str(tmp_path)
+    try:
+        watcher = InotifyWatcher(root)
+    except Exception:
+        pytest.skip('inotify is not available')
+    try:
+        os.mkdir(os.path.join(root, 'sub'))
+        write(os.path.join(root, 'sub', 'new.png'))
+        write(os.path.join(root, 'top.png'))
+        expected = set([os.path.join(root, 'sub', 'new.png'), os.path.join(root, 'top.png')])
+        assert read_until(watcher, expected) == expected
+    finally:
+        watcher.close()